@@ -1,4 +1,23 @@
-def tide_constituents(dates, elevation):
+import sys
+from pathlib import Path
+
+# the astronomic cache is shared with the tide_constituents scripts
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'tide_constituents'))
+from astronomic_cache import AstronomicCache
+
+astro_cache_size = 8
+_astro_caches = {}
+
+
+def astro_cache(cache_dir=None):
+    """The AstronomicCache that pickles its entries in cache_dir (or keeps
+    them in memory only if it is None)."""
+    if cache_dir not in _astro_caches:
+        _astro_caches[cache_dir] = AstronomicCache(astro_cache_size, cache_dir)
+    return _astro_caches[cache_dir]
+
+
+def _setup(dates, rayleigh=1.0, cache_dir=None):
     from tappy import tappy
 
     quiet = True
@@ -6,7 +25,6 @@ def tide_constituents(dates, elevation):
     outputts = False
     outputxml = False
     ephemeris = False
-    rayleigh = 1.0
     print_vau_table = False
     missing_data = 'ignore'
     linear_trend = False
@@ -16,8 +34,7 @@ def tide_constituents(dates, elevation):
     pad_filters = None
     include_inferred = True
 
-    if rayleigh:
-        ray = float(rayleigh)
+    ray = float(rayleigh) if rayleigh else 0.0
 
     x = tappy.tappy(
         outputts=outputts,
@@ -37,13 +54,15 @@ def tide_constituents(dates, elevation):
     )
 
     x.dates = dates
-    x.elevation = elevation
-    package = x.astronomic(x.dates)
+    package, (x.speed_dict, x.key_list) = astro_cache(cache_dir).load(x, ray)
     (x.zeta, x.nu, x.nup, x.nupp, x.kap_p, x.ii, x.R, x.Q, x.T, x.jd, x.s, x.h,
      x.N, x.p, x.p1) = package
-    (x.speed_dict, x.key_list) = x.which_constituents(len(x.dates),
-                                                      package,
-                                                      rayleigh_comp=ray)
+    return x
+
+
+def tide_constituents(dates, elevation, cache_dir=None):
+    x = _setup(dates, cache_dir=cache_dir)
+    x.elevation = elevation
 
     # the analysis
     x.constituents()
@@ -51,28 +70,82 @@ def tide_constituents(dates, elevation):
     return x
 
 
-def _decompose(dates, elvs_list):
-    from tqdm import tqdm
+def design_matrix(dates, speed_dict, key_list):
+    """Harmonic design matrix with a mean column followed by a cosine and
+    a sine column per constituent; hours are counted from the first date
+    as in tappy.
+    """
+    import numpy as np
 
-    amps_list, phases_list = [], []
-    for elvs in tqdm(elvs_list):
-        con = tide_constituents(dates, elvs)
-        amps_list.append((con.r['M2'], con.r['M4']))
-        phases_list.append((con.phase['M2'], con.phase['M4']))
-    return [amps_list, phases_list]
+    t = np.asarray(dates, dtype='datetime64[ns]')
+    hours = (t - t[0]) / np.timedelta64(1, 'h')
 
+    deg2rad = np.pi / 180.0
+    columns = [np.ones_like(hours)]
+    for key in key_list:
+        ff = np.broadcast_to(speed_dict[key]['FF'], hours.shape)
+        arg = speed_dict[key]['speed'] * hours + speed_dict[key]['VAU'] * deg2rad
+        columns += [ff * np.cos(arg), ff * np.sin(arg)]
+    return np.column_stack(columns)
 
-def decompose(dates, elvs_list):
-    import multiprocessing
-    from functools import partial
+
+def harmonic_analysis(dates, elevations, cache_dir=None):
+    """Least-squares harmonic analysis of many series sharing the same dates.
+
+    The astronomic arguments and the constituent selection are computed once
+    and all the series (columns of ``elevations`` with shape (time, nodes))
+    are fitted in a single solve. Series with missing values are fitted
+    individually on their valid samples. If cache_dir is given, the
+    astronomic arguments are also cached there for later runs.
+
+    Returns: mean level, amplitude and phase (deg); the last two are
+             dictionaries of constituent name to an array over the nodes.
+    """
+    import numpy as np
+
+    x = _setup(dates, cache_dir=cache_dir)
+    a = design_matrix(x.dates, x.speed_dict, x.key_list)
+
+    y = np.asarray(elevations, dtype=np.float64)
+    if y.ndim == 1:
+        y = y[:, None]
+
+    coef = np.empty((a.shape[1], y.shape[1]))
+    valid = ~np.isnan(y)
+    full = valid.all(axis=0)
+    if full.any():
+        coef[:, full] = np.linalg.lstsq(a, y[:, full], rcond=None)[0]
+    for n in np.where(~full)[0]:
+        rows = valid[:, n]
+        if rows.sum() < a.shape[1]:
+            coef[:, n] = np.nan
+            continue
+        coef[:, n] = np.linalg.lstsq(a[rows], y[rows, n], rcond=None)[0]
+
+    z0 = coef[0]
+    amp, phase = {}, {}
+    for i, key in enumerate(x.key_list):
+        c, s = coef[2 * i + 1], coef[2 * i + 2]
+        amp[key] = np.hypot(c, s)
+        phase[key] = np.rad2deg(np.arctan2(s, c)) % 360.0
+    return z0, amp, phase
+
+
+def decompose(dates, elvs_list, cache_dir=None):
     import numpy as np
 
-    pool = multiprocessing.Pool()
-    print('Computing the tidal constituents in parallel with ' +
-          f'{pool._processes} processors ...')
-    decompose_el = partial(_decompose, dates)
-    tide_list = pool.map(decompose_el, elvs_list)
-    pool.close()
-    amps_list = [np.column_stack(tide[0]) for tide in tide_list]
-    phases_list = [np.column_stack(tide[1]) for tide in tide_list]
+    print('Computing the tidal constituents for ' +
+          f'{sum(len(e) for e in elvs_list)} nodes ...')
+    _, amp, phase = harmonic_analysis(
+        dates,
+        np.column_stack([np.transpose(e) for e in elvs_list]),
+        cache_dir=cache_dir)
+
+    amps_list, phases_list = [], []
+    start = 0
+    for elvs in elvs_list:
+        nodes = slice(start, start + len(elvs))
+        amps_list.append(np.vstack((amp['M2'][nodes], amp['M4'][nodes])))
+        phases_list.append(np.vstack((phase['M2'][nodes], phase['M4'][nodes])))
+        start = nodes.stop
     return amps_list, phases_list
@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import xarray as xr
 import utils
 from pathlib import Path
 from sys import argv
@@ -8,14 +7,14 @@ import itertools
 import vis
 
 dirname = argv[1:]
-res_list, inp_list = [], []
+map_list, inp_list = [], []
 for d in dirname:
     fname = [Path(d, n) for n in ['FlowFM_map.nc', 'inputs.txt']]
     for f in fname:
         if not Path(f).exists():
             raise FileNotFoundError(f'{f} not found')
 
-    res_list.append(xr.open_dataset(fname[0]))
+    map_list.append(fname[0])
     inp_list.append(utils.read_data(fname[1]))
 
 plot_id = [inp['plot'] for inp in inp_list]
@@ -26,20 +25,25 @@ for i, f in enumerate(plot_id):
     cs_idx.append(1 if f[1] == 'T' else 0)
     tc_idx.append(1 if f[2] == 'T' else 0)
 
-res, inp = list(itertools.compress(res_list, wl_idx)), list(
-    itertools.compress(inp_list, wl_idx))
+
+def open_maps(idx, kind):
+    return [
+        utils.open_map(f, utils.map_variables[kind])
+        for f in itertools.compress(map_list, idx)
+    ], list(itertools.compress(inp_list, idx))
+
+
+res, inp = open_maps(wl_idx, 'water_surface')
 if len(res) > 0 and len(inp) > 0:
     water_level = vis.WaterSurface(res, inp)
     water_level.animate()
 
-res, inp = list(itertools.compress(res_list, cs_idx)), list(
-    itertools.compress(inp_list, cs_idx))
+res, inp = open_maps(cs_idx, 'cross_section')
 if len(res) > 0 and len(inp) > 0:
     cross_section = vis.CrossSection(res, inp)
     cross_section.animate()
 
-res, inp = list(itertools.compress(res_list, tc_idx)), list(
-    itertools.compress(inp_list, tc_idx))
+res, inp = open_maps(tc_idx, 'tidal_constituents')
 if len(res) > 0 and len(inp) > 0:
     tidal_constituents = vis.TidalConstituents(res, inp)
     tidal_constituents.plot_constituents()
@@ -25,6 +25,202 @@ def read_data(fname):
     return config
 
 
+# Variables of FlowFM_map.nc read by each plot type (besides coordinates)
+map_variables = {
+    'water_surface': ['mesh2d_face_x', 'mesh2d_face_y', 'mesh2d_s1'],
+    'cross_section': ['mesh2d_face_x', 'mesh2d_face_y', 'mesh2d_s1'],
+    'tidal_constituents':
+    ['mesh2d_face_x', 'mesh2d_face_y', 'mesh2d_s1', 'mesh2d_ucy'],
+}
+
+
+def face_dim(obj):
+    """Name of the face dimension of a map dataset or of a (time, face)
+    variable."""
+    if hasattr(obj, 'data_vars'):
+        obj = obj.mesh2d_face_x
+    return obj.dims[-1]
+
+
+def open_map(fname, variables, faces=None, chunks=None):
+    """Opens only the given variables of a D-Flow FM map file, lazily.
+
+    Nothing is read until values are requested and selections by index
+    (e.g. da.isel(mesh2d_nFaces=idx)) are passed on to the file read, so
+    only the selected faces are ever read. If faces (indices) are given,
+    they are selected right away. chunks=(time, faces) splits the variables
+    into dask chunks instead; that suits reductions over whole variables
+    but selections then read the full chunks they touch.
+    """
+    import xarray as xr
+
+    ds = xr.open_dataset(fname, cache=False)
+    ds = ds[[v for v in variables if v in ds.variables]]
+    if faces is not None:
+        ds = ds.isel({face_dim(ds): faces})
+    if chunks is not None:
+        ds = ds.chunk({'time': chunks[0], face_dim(ds): chunks[1]})
+    return ds
+
+
+def reopen(ds):
+    """Opens the variables of a map dataset (see open_map) from its file
+    again, e.g. in a worker process so that it does not read through the
+    file handle inherited from its parent; HDF5 handles are not fork-safe."""
+    return open_map(ds.encoding['source'], list(ds.variables))
+
+
+def abs_max(da, step=48):
+    """Largest absolute value of a (time, ...) variable, reading it step
+    time steps at a time."""
+    import numpy as np
+
+    return max(
+        float(np.abs(da.isel(time=slice(t, t + step)).values).max())
+        for t in range(0, da.sizes['time'], step))
+
+
+def nearest_faces(ds, x, y):
+    """Indices of the faces whose centres are the nearest to the points."""
+    import numpy as np
+    from scipy.spatial import cKDTree
+
+    tree = cKDTree(
+        np.column_stack((ds.mesh2d_face_x.values, ds.mesh2d_face_y.values)))
+    return tree.query(np.column_stack((np.ravel(x), np.ravel(y))))[1]
+
+
+def extract(ds, variables, faces=None, x=None, y=None):
+    """Time series of the variables at the given faces or at the faces
+    nearest to the x/y points.
+
+    Each variable is read with a single orthogonal selection of all the
+    (unique) faces, so only those faces are read from the file.
+
+    Returns: a dictionary of variable name to a (time, point) array.
+    """
+    import numpy as np
+
+    if faces is None:
+        faces = nearest_faces(ds, x, y)
+    faces, inverse = np.unique(np.atleast_1d(faces), return_inverse=True)
+    sub = ds[list(variables)].isel({face_dim(ds): faces})
+    return {v: sub[v].values[:, inverse] for v in variables}
+
+
+class Interpolator():
+    """Linear interpolation from scattered source points to fixed targets.
+
+    The Delaunay triangulation and barycentric weights are computed once and
+    stored as a sparse (target, source) matrix, so interpolating a frame is a
+    single sparse product; targets outside the triangulation get NaN as with
+    griddata. If the targets are the source points no operator is built and
+    the values are returned as they are.
+    """
+    def __init__(self, xs, ys, xt, yt):
+        import numpy as np
+        from scipy.spatial import Delaunay
+        from scipy.sparse import csr_matrix
+
+        source = np.column_stack((xs, ys))
+        target = np.column_stack((xt, yt))
+        self.weights, self.outside = None, None
+        if source.shape == target.shape and np.array_equal(source, target):
+            return
+
+        tri = Delaunay(source)
+        simplex = tri.find_simplex(target)
+        inside = np.where(simplex >= 0)[0]
+        t = tri.transform[simplex[inside]]
+        b = np.einsum('ijk,ik->ij', t[:, :2], target[inside] - t[:, 2])
+        b = np.column_stack((b, 1.0 - b.sum(axis=1)))
+
+        self.weights = csr_matrix(
+            (b.ravel(), (np.repeat(inside, 3),
+                         tri.simplices[simplex[inside]].ravel())),
+            shape=(len(target), len(source)))
+        self.outside = simplex < 0
+
+    def __call__(self, values):
+        if self.weights is None:
+            return values
+        out = self.weights @ values
+        out[self.outside] = float('nan')
+        return out
+
+
+_interpolators = {}
+
+
+def interpolator(xs, ys, xt, yt):
+    """An Interpolator shared by all the calls with the same source and
+    target points, e.g. by the runs of a study on the same mesh."""
+    import hashlib
+    import numpy as np
+
+    key = hashlib.sha1(b''.join(
+        np.ascontiguousarray(a, dtype=np.float64).tobytes()
+        for a in (xs, ys, xt, yt))).hexdigest()
+    if key not in _interpolators:
+        _interpolators[key] = Interpolator(xs, ys, xt, yt)
+    return _interpolators[key]
+
+
+class FrameRenderer():
+    """A figure that is built once and redrawn for every frame.
+
+    build(t) draws frame t and returns the figure, its canvas and the
+    artists that change between frames; the caller updates those artists
+    (e.g. set_ydata or set_array) and calls draw. With blit=True the rest of
+    the figure is rendered once and restored as a background, so only the
+    changing artists are drawn for each frame.
+    """
+    def __init__(self, build, t, dpi=300, blit=False):
+        self.fig, self.canvas, self.artists = build(t)
+        self.fig.set_dpi(dpi)
+        self.blit = blit
+        if blit:
+            for a in self.artists:
+                a.set_animated(True)
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    def draw(self):
+        if self.blit:
+            self.canvas.restore_region(self.background)
+            for a in self.artists:
+                a.axes.draw_artist(a)
+        else:
+            self.canvas.draw()
+
+
+_renderers = {}
+
+
+def renderer(key, build, t, dpi=300, blit=False):
+    """The FrameRenderer of key in this process (e.g. a pool worker), built
+    from frame t on first use. Only the renderer of the last key is kept."""
+    if key not in _renderers:
+        _renderers.clear()
+        _renderers[key] = FrameRenderer(build, t, dpi, blit)
+    return _renderers[key]
+
+
+def save_png(canvas, output):
+    """Saves what has been drawn on the canvas as a PNG file."""
+    import numpy as np
+    from matplotlib.image import imsave
+
+    imsave(output, np.asarray(canvas.buffer_rgba()))
+
+
+def rgba(canvas):
+    """Returns: the width, height and RGBA bytes of what has been drawn on
+             the canvas."""
+    buffer = canvas.buffer_rgba()
+    return buffer.shape[1], buffer.shape[0], bytes(buffer)
+
+
 def make_canvas(width, height, nx=1, ny=1):
     from matplotlib.figure import Figure
     from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
@@ -96,29 +292,138 @@ def latexify(fig_width=None, fig_height=None, columns=1):
     matplotlib.rcParams.update(params)
 
 
+def _encoders(output, fname, size, video=True, gif=False):
+    """ffmpeg processes encoding raw RGBA frames of the given size read from
+    their stdin into the video and/or the gif."""
+    import subprocess
+    from pathlib import Path
+
+    source = [
+        'ffmpeg',
+        '-f', 'rawvideo',
+        '-pix_fmt', 'rgba',
+        '-s', f'{size[0]}x{size[1]}',
+        '-framerate', '12',
+        '-i', '-',
+        '-hide_banner',
+        '-loglevel', 'panic',
+        '-y',
+    ]
+    encoders = []
+    if video:
+        encoders.append(subprocess.Popen(source + [
+            '-c:v', 'libx264',
+            '-preset', 'slow',
+            '-profile:v', 'high',
+            '-level:v', '4.0',
+            '-pix_fmt', 'yuv420p',
+            '-crf', '22',
+            Path(output, f'{fname}.mp4')
+        ], stdin=subprocess.PIPE))
+    if gif:
+        encoders.append(subprocess.Popen(source + [
+            '-filter_complex',
+            'fps=10,scale=iw*0.3:-1,split[a][b];[a]palettegen[p];[b][p]paletteuse',
+            Path(output, f'{fname}.gif')
+        ], stdin=subprocess.PIPE))
+    return encoders
+
+
+_frame_func = None
+
+
+def _init_frames(func, init=None):
+    """Pool initializer that keeps the frame function in the worker, so a
+    plotter's bound method is pickled once per process and not per frame.
+    init is called first, e.g. to reopen the files that func reads."""
+    global _frame_func
+    if init is not None:
+        init()
+    _frame_func = func
+
+
+def _frame(t):
+    return _frame_func(t)
+
+
+def stream(func, frames, output, fname, video=True, gif=False, window=None, init=None):
+    """Renders the frames in parallel and pipes them in order to ffmpeg.
+
+    func(t) returns frame t as (width, height, RGBA bytes), see rgba. At
+    most window frames (twice the processes by default) are rendered ahead
+    of the one being encoded, so frames that finish early wait in a bounded
+    buffer until their turn. init is called once in every worker before
+    its first frame.
+    """
+    import multiprocessing
+    from collections import deque
+
+    encoders = None
+    frames = iter(frames)
+    try:
+        with multiprocessing.Pool(initializer=_init_frames, initargs=(func, init)) as pool:
+            window = 2 * pool._processes if window is None else window
+            print(f'Plotting in parallel with {pool._processes} processors ...')
+
+            pending = deque(
+                pool.apply_async(_frame, (t, )) for _, t in zip(range(window), frames))
+            while pending:
+                width, height, frame = pending.popleft().get()
+                t = next(frames, None)
+                if t is not None:
+                    pending.append(pool.apply_async(_frame, (t, )))
+
+                if encoders is None:
+                    encoders = _encoders(output, fname, (width, height), video, gif)
+                for p in encoders:
+                    p.stdin.write(frame)
+    finally:
+        for p in encoders or []:
+            p.stdin.close()
+            p.wait()
+
+
 def animation(func,
               frames,
               output,
               fname,
               video=True,
               gif=False,
-              clean_up=True):
+              clean_up=True,
+              png=True,
+              init=None):
+    """Makes a video (and/or a gif) of the frames.
+
+    If png is True, func(t) saves frame t as images/frame_{t:03d}.png and
+    the video is made from these files. Otherwise func(t) returns the frame
+    as (width, height, RGBA bytes) and the frames are piped to ffmpeg
+    without touching the disk (see stream). init is called once in every
+    worker process before its first frame.
+    """
     import time as dt
     import subprocess
     import multiprocessing
     from pathlib import Path
     import os
 
-    if not Path('images').exists():
-        Path('images').mkdir()
     if not Path(output).exists():
         Path(output).mkdir()
 
+    if not png:
+        starttime = dt.time()
+        stream(func, frames, output, fname, video, gif, init=init)
+        print(f'Plotting and encoding finished after {dt.time() - starttime:.1f} seconds')
+        print('Completed successfully')
+        return
+
+    if not Path('images').exists():
+        Path('images').mkdir()
+
     starttime = dt.time()
-    pool = multiprocessing.Pool()
+    pool = multiprocessing.Pool(initializer=_init_frames, initargs=(func, init))
     print(f'Plotting in parallel with {pool._processes} processors ...')
 
-    pool.map(func, frames)
+    pool.map(_frame, frames)
     pool.close()
 
     print(f'Plotting finished after {dt.time() - starttime:.1f} seconds')
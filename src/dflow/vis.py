@@ -19,17 +19,18 @@ class CrossSection():
         self.nx = self.res_list[0].mesh2d_face_x.values
         self.ny = self.res_list[0].mesh2d_face_y.values
         self.center = np.where((self.nx > self.inp_list[0]['x_center'] - 300)
-                               & (self.nx < self.inp_list[0]['x_center']))
+                               & (self.nx < self.inp_list[0]['x_center']))[0]
         self.ny_center = self.ny[self.center]
         self.idx_sort = np.argsort(self.ny_center)[::-1]
         self.ny_center = self.ny_center[self.idx_sort]
         self.wd_center = [
-            res.mesh2d_s1.values[:, self.center] for res in self.res_list
+            res.mesh2d_s1.isel({
+                utils.face_dim(res): self.center
+            }).values for res in self.res_list
         ]
 
         self.ymax = np.array([
-            np.absolute(res.mesh2d_s1.values).max() * 1.1
-            for res in self.res_list
+            utils.abs_max(res.mesh2d_s1) * 1.1 for res in self.res_list
         ]).max()
         self.ymin = -self.ymax
 
@@ -38,26 +39,53 @@ class CrossSection():
         if "Ref" in self.title:
             self.title.remove("Ref")
 
+        self.persistent = self.inp_list[-1].get('persistent', 'F') == 'T'
+        self.blit = self.inp_list[-1].get('blit', 'F') == 'T'
+        self.png = self.inp_list[-1].get('png', 'F') == 'T'
+
     def animate(self):
         print("Cross section visualization ...")
-        utils.animation(self.plot_func,
+        utils.animation(self.plot_func if self.png else self.render,
                         range(0, self.res_list[0].time.shape[0],
                               1), self.output,
-                        'cs_' + self.inp_list[-1]['label'].replace(' ', ''))
+                        'cs_' + self.inp_list[-1]['label'].replace(' ', ''),
+                        png=self.png)
 
     def plot_func(self, t):
-        import matplotlib.colors as mcolors
-
         output = Path('images', f'frame_{t:03d}.png')
         if output.exists():
             return
+        utils.save_png(self.draw(t), output)
+
+    def render(self, t):
+        return utils.rgba(self.draw(t))
+
+    def draw(self, t):
+        """Draws frame t at 300 dpi and returns its canvas."""
+        if self.persistent:
+            r = utils.renderer('cs_' + self.labels[-1], self.figure, t,
+                               blit=self.blit)
+            for line, w in zip(r.artists, self.wd_center):
+                line.set_ydata(w[t][self.idx_sort])
+            r.draw()
+            return r.canvas
+
+        fig, canvas, _ = self.figure(t)
+        fig.set_dpi(300)
+        canvas.draw()
+        return canvas
+
+    def figure(self, t):
+        import matplotlib.colors as mcolors
 
         fig, gs, canvas = utils.make_canvas(8, 5)
         ax = fig.add_subplot(gs[0])
 
         colors = list(mcolors.TABLEAU_COLORS.keys())[:len(self.wd_center)]
-        for w, l, c in zip(self.wd_center, self.labels, colors):
-            ax.plot(self.ny_center, w[t][0][self.idx_sort], label=f'{l}', c=c)
+        lines = [
+            ax.plot(self.ny_center, w[t][self.idx_sort], label=f'{l}', c=c)[0]
+            for w, l, c in zip(self.wd_center, self.labels, colors)
+        ]
 
         ax.set_title(
             f'{self.title[0]} study; cross-section across the middle of the ' +
@@ -68,7 +96,7 @@ class CrossSection():
         ax.set_ylabel('Water Level (m)')
         ax.legend(loc='upper right')
         ax.ticklabel_format(style='sci', axis='x', scilimits=(3, 3))
-        canvas.print_figure(output, format="png", dpi=300)
+        return fig, canvas, lines
 
 
 class WaterSurface():
@@ -81,14 +109,17 @@ class WaterSurface():
             Path(self.output).mkdir()
 
         self.vmax = np.array([
-            np.absolute(res.mesh2d_s1.values).max() * 1.1
-            for res in self.res_list
+            utils.abs_max(res.mesh2d_s1) * 1.1 for res in self.res_list
         ]).max()
         self.vmin = -self.vmax
         self.title = [inp['title'] for inp in self.inp_list]
         if "Ref" in self.title:
             self.title.remove("Ref")
 
+        self.persistent = self.inp_list[-1].get('persistent', 'F') == 'T'
+        self.blit = self.inp_list[-1].get('blit', 'F') == 'T'
+        self.png = self.inp_list[-1].get('png', 'F') == 'T'
+
     def animate(self):
         from matplotlib import tri, cm
         from tqdm import tqdm
@@ -100,13 +131,17 @@ class WaterSurface():
                              total=len(self.res_list)):
             self.nx = res.mesh2d_face_x.values
             self.ny = res.mesh2d_face_y.values
+            self.res = res
             self.wd = res.mesh2d_s1
+            self.ref = None
 
             self.norm = cm.colors.Normalize(vmax=self.vmax, vmin=self.vmin)
             self.cmap = cm.PRGn
             self.levels = np.arange(self.vmin, self.vmax, 0.05)
 
             self.triang = tri.Triangulation(self.nx, self.ny)
+            self.interp = utils.interpolator(self.nx, self.ny, self.triang.x,
+                                             self.triang.y)
             x = self.nx[self.triang.triangles].mean(axis=1)
             y = self.ny[self.triang.triangles].mean(axis=1)
 
@@ -160,39 +195,78 @@ class WaterSurface():
             self.triang.set_mask(mask)
 
             self.label = 'wl_' + inp['label']
-            utils.animation(self.plot_func, range(0, self.wd.time.shape[0], 1),
-                            self.output, self.label.replace(' ', ''))
+            utils.animation(self.plot_func if self.png else self.render,
+                            range(0, self.wd.time.shape[0], 1),
+                            self.output, self.label.replace(' ', ''),
+                            png=self.png, init=self.reopen)
             if itr > 0:
-                self.wd = self.res_list[0].mesh2d_s1 - self.wd
+                self.ref = self.res_list[0].mesh2d_s1
                 self.label = 'RDiff ' + self.label
-                utils.animation(self.plot_func,
+                utils.animation(self.plot_func if self.png else self.render,
                                 range(0, self.wd.time.shape[0], 1),
-                                self.output, self.label.replace(' ', ''))
+                                self.output, self.label.replace(' ', ''),
+                                png=self.png, init=self.reopen)
             itr = +1
 
-    def plot_func(self, t):
-        from matplotlib import cm
-        from scipy.interpolate import griddata
+    def reopen(self):
+        """Reopens the maps of the current animation in a worker process."""
+        self.wd = utils.reopen(self.res).mesh2d_s1
+        if self.ref is not None:
+            self.ref = utils.reopen(self.res_list[0]).mesh2d_s1
+
+    def frame(self, t):
+        wdt = self.wd.isel(time=t).values
+        if self.ref is not None:
+            wdt = self.ref.isel(time=t).values - wdt
+        return self.interp(wdt)
 
+    def plot_func(self, t):
         output = Path('images', f'frame_{t:03d}.png')
         if output.exists():
             return
+        utils.save_png(self.draw(t), output)
+
+    def render(self, t):
+        return utils.rgba(self.draw(t))
+
+    def draw(self, t):
+        """Draws frame t at 300 dpi and returns its canvas."""
+        if self.persistent:
+            r = utils.renderer(self.label, self.figure, t, blit=self.blit)
+            tris = self.triang.get_masked_triangles()
+            r.artists[0].set_array(self.frame(t)[tris].mean(axis=1))
+            r.draw()
+            return r.canvas
+
+        fig, canvas, _ = self.figure(t)
+        fig.set_dpi(300)
+        canvas.draw()
+        return canvas
+
+    def figure(self, t):
+        """Filled contours of frame t or, for persistent rendering, a
+        tripcolor plot (the mean of each triangle) whose colours can be
+        updated for the next frames."""
+        from matplotlib import cm
 
         fig, gs, canvas = utils.make_canvas(5.5, 7)
         ax = fig.add_subplot(gs[0])
 
-        wdt = griddata((self.nx, self.ny),
-                       self.wd.isel(time=t).values,
-                       (self.triang.x, self.triang.y),
-                       method='linear')
-
-        tcf = ax.tricontourf(self.triang,
-                             wdt,
-                             self.levels,
-                             cmap=cm.get_cmap(self.cmap,
-                                              len(self.levels) - 1),
-                             norm=self.norm)
-        ax.tricontour(self.triang, wdt, tcf.levels, colors='k')
+        wdt = self.frame(t)
+        cmap = cm.get_cmap(self.cmap, len(self.levels) - 1)
+        if self.persistent:
+            tcf = ax.tripcolor(self.triang,
+                               wdt,
+                               cmap=cmap,
+                               norm=self.norm,
+                               shading='flat')
+        else:
+            tcf = ax.tricontourf(self.triang,
+                                 wdt,
+                                 self.levels,
+                                 cmap=cmap,
+                                 norm=self.norm)
+            ax.tricontour(self.triang, wdt, tcf.levels, colors='k')
 
         ax.set_title(
             f'{self.title[0]} study; water level contours for {self.label.strip()}'
@@ -200,17 +274,19 @@ class WaterSurface():
         ax.set_xlim(self.nx.min(), self.nx.max())
         ax.set_ylim(self.ny.min(), self.ny.max())
         ax.ticklabel_format(style='sci', scilimits=(3, 3))
-        fig.colorbar(tcf,
-                     norm=self.norm,
-                     ax=ax,
-                     use_gridspec=True,
-                     extend=[self.vmin, self.vmax])
-        canvas.print_figure(output, format="png", dpi=300)
+        if self.persistent:
+            fig.colorbar(tcf, norm=self.norm, ax=ax, use_gridspec=True)
+        else:
+            fig.colorbar(tcf,
+                         norm=self.norm,
+                         ax=ax,
+                         use_gridspec=True,
+                         extend=[self.vmin, self.vmax])
+        return fig, canvas, [tcf]
 
 
 class TidalConstituents():
     def __init__(self, res_list, inp_list):
-        from datetime import datetime
         import pandas as pd
         import analysis
 
@@ -223,9 +299,7 @@ class TidalConstituents():
         if not Path(self.output).exists():
             Path(self.output).mkdir()
 
-        self.dates = res_list[0].time.values.astype(int) * 1e-9
-        self.dates = np.array(
-            [datetime.utcfromtimestamp(t) for t in self.dates])
+        self.dates = pd.to_datetime(res_list[0].time.values).to_pydatetime()
 
         self.nx = self.res_list[0].mesh2d_face_x.values
         self.ny = self.res_list[0].mesh2d_face_y.values
@@ -236,6 +310,11 @@ class TidalConstituents():
             & (self.ny < self.inp_list[0]['y_mouth'] + 1100))[0]
 
         self.mouth_idx = np.intersect1d(self.center, self.mouth_idx)
+        if self.mouth_idx.size == 0:
+            raise ValueError(
+                'no faces were found at the mouth: check x_center and y_mouth '
+                + f'(x_center={self.inp_list[0]["x_center"]}, '
+                + f'y_mouth={self.inp_list[0]["y_mouth"]})')
 
         if not Path(self.output).exists():
             Path(self.output).mkdir()
@@ -247,15 +326,13 @@ class TidalConstituents():
                     & (self.ny < self.inp_list[0]['y_o'] + 1100))[0]
                 bay_idx = np.intersect1d(self.center, bay_idx)
 
-                uy_bay = np.array(
-                    [u[bay_idx].values[0] for u in res_list[i].mesh2d_ucy])
-                el_bay = np.array(
-                    [w[bay_idx].values[0] for w in res_list[i].mesh2d_s1])
+                bay = utils.extract(res_list[i], ['mesh2d_s1', 'mesh2d_ucy'],
+                                    bay_idx[:1])
 
                 df = pd.DataFrame(columns=['date', 'water level', 'velocity'])
                 df['date'] = self.dates
-                df['water level'] = el_bay
-                df['velocity'] = uy_bay
+                df['water level'] = bay['mesh2d_s1'][:, 0]
+                df['velocity'] = bay['mesh2d_ucy'][:, 0]
                 df.to_csv(Path(
                     self.output,
                     f'bay_{inp_list[i]["label"].replace(" ", "_")}.csv'),
@@ -265,26 +342,22 @@ class TidalConstituents():
         self.idx_sort = np.argsort(self.ny_center)[::-1]
         self.ny_center = self.ny_center[self.idx_sort]
 
-        wl_list = [res.mesh2d_s1 for res in res_list]
-        self.elv_mouth, self.wd_center, self.elvs_list = [], [], []
-        for wl in wl_list:
-            self.elv_mouth.append(
-                np.array([w[self.mouth_idx].values[0] for w in wl]))
-            self.wd_center.append(wl.values[:, self.center])
-            self.elvs_list.append(
-                np.column_stack([
-                    wl.isel(time=t)[self.center[::4]].values
-                    for t in range(wl_list[0].time.shape[0])
-                ]))
-
-        uy_list = [res.mesh2d_ucy for res in res_list]
+        # the mouth series come from its first face
+        wl_list = self.extract(['mesh2d_s1'],
+                               np.append(self.mouth_idx[:1], self.center))
+        self.elv_mouth = [wl['mesh2d_s1'][:, 0] for wl in wl_list]
+        self.wd_center = [wl['mesh2d_s1'][:, 1:] for wl in wl_list]
+        self.elvs_list = [wl['mesh2d_s1'][:, 1::4].T for wl in wl_list]
+
         self.uy_mouth = [
-            np.array([u[self.mouth_idx].values[0] for u in uy])
-            for uy in uy_list
+            uy['mesh2d_ucy'][:, 0]
+            for uy in self.extract(['mesh2d_ucy'], self.mouth_idx[:1])
         ]
 
         self.amps_list, self.phases_list = analysis.decompose(
-            self.dates, self.elvs_list)
+            self.dates,
+            self.elvs_list,
+            cache_dir=self.inp_list[0].get('cache_dir'))
 
         self.labels = [inp['label'] for inp in self.inp_list]
 
@@ -312,6 +385,17 @@ class TidalConstituents():
                       index=False)
             itr += 1
 
+    def extract(self, variables, faces=None, x=None, y=None):
+        """Time series of the variables of every run at the given faces or
+        at the faces nearest to the x/y points (see utils.extract).
+
+        Returns: a list of dictionaries of variable name to a (time, point)
+                 array, one per run.
+        """
+        if faces is None:
+            faces = utils.nearest_faces(self.res_list[0], x, y)
+        return [utils.extract(res, variables, faces) for res in self.res_list]
+
     def plot_constituents(self):
         import matplotlib.colors as mcolors
 
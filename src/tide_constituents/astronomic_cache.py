@@ -0,0 +1,64 @@
+import numpy as np
+import os
+
+
+class AstronomicCache():
+    """
+    LRU cache of the astronomic arguments and the Rayleigh constituent
+    selection of tappy, keyed by a hash of the dates and the Rayleigh value.
+    If cache_dir is given, the entries are also pickled there so that later
+    runs on the same time axis can reuse them.
+    """
+    def __init__(self, maxsize=16, cache_dir=None):
+        from collections import OrderedDict
+
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(dates, rayleigh):
+        import hashlib
+
+        t = np.ascontiguousarray(np.asarray(dates, dtype='datetime64[ns]'))
+        h = hashlib.sha1(t.view('i8').tobytes())
+        h.update(repr(float(rayleigh)).encode())
+        return h.hexdigest()
+
+    def load(self, x, rayleigh):
+        """
+        Returns: (package, (speed_dict, key_list)) for x.dates where x is a
+                 tappy object; the returned objects are copies that can be
+                 modified freely.
+        """
+        import copy
+        import pickle
+        from pathlib import Path
+
+        key = self.key(x.dates, rayleigh)
+        entry = self._entries.pop(key, None)
+
+        path = None if self.cache_dir is None else Path(self.cache_dir, f'{key}.pkl')
+        if entry is None and path is not None and path.exists():
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+
+        if entry is None:
+            package = x.astronomic(x.dates)
+            entry = (package, x.which_constituents(len(x.dates), package,
+                                                   rayleigh_comp=rayleigh))
+            if path is not None:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+                with open(tmp, 'wb') as f:
+                    pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+
+        self._entries[key] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+        return copy.deepcopy(entry)
+
+    def clear(self):
+        self._entries.clear()
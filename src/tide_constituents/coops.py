@@ -0,0 +1,131 @@
+import pandas as pd
+
+
+api_url = 'https://api.tidesandcurrents.noaa.gov/api/prod/datagetter'
+
+# Longest range (days) that CO-OPS serves in one request for each interval
+max_days = {None: 31, '6': 31, 'h': 365, 'hilo': 365}
+
+columns = {'water_level': {'t': 'date_time', 'v': 'water_level', 's': 'sigma',
+                           'f': 'flags', 'q': 'QC'},
+           'hourly_height': {'t': 'date_time', 'v': 'water_level', 's': 'sigma',
+                             'f': 'flags'},
+           'predictions': {'t': 'date_time', 'v': 'predicted_wl', 'type': 'type'}}
+
+
+def chunks(start, end, interval=None):
+    """Splits the days between start and end (inclusive) into the ranges
+    that CO-OPS accepts in a single request."""
+    start, end = pd.to_datetime(start).normalize(), pd.to_datetime(end).normalize()
+    step = pd.Timedelta(days=max_days[interval])
+    ranges = []
+    while start <= end:
+        ranges.append((start, min(start + step - pd.Timedelta(days=1), end)))
+        start = ranges[-1][1] + pd.Timedelta(days=1)
+    return ranges
+
+
+def _get_chunk(session, url, params, product):
+    r = session.get(url, params=params, timeout=60)
+    r.raise_for_status()
+    payload = r.json()
+    if 'error' in payload:
+        if 'no data' in payload['error'].get('message', '').lower():
+            return None
+        raise ValueError(payload['error'].get('message', str(payload['error'])))
+
+    key = 'predictions' if product == 'predictions' else 'data'
+    data = pd.DataFrame(payload[key]).rename(columns=columns.get(product, {'t': 'date_time'}))
+    data['date_time'] = pd.to_datetime(data.date_time)
+    for c in data.columns:
+        if c in ['water_level', 'sigma', 'predicted_wl']:
+            data[c] = pd.to_numeric(data[c], errors='coerce')
+    return data.set_index('date_time')
+
+
+def get_data(station_id, start, end, product, datum='MSL', interval=None,
+             units='metric', time_zone='gmt', workers=8, session=None, url=api_url):
+    """
+    Downloads a CO-OPS product for any range by splitting it into compliant
+    chunks that are fetched concurrently over a pooled session (failed
+    requests are retried with backoff) and stitched into one sorted frame
+    without duplicate dates. Hourly water levels are served by CO-OPS as the
+    hourly_height product.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from noaa_stations import make_session
+
+    session = make_session(workers, retries=5) if session is None else session
+    if product == 'water_level' and interval == 'h':
+        product, interval = 'hourly_height', None
+        days = 'h'
+    else:
+        days = interval
+
+    params = []
+    for s, e in chunks(start, end, days):
+        p = {'station': str(station_id),
+             'begin_date': s.strftime('%Y%m%d'),
+             'end_date': e.strftime('%Y%m%d'),
+             'product': product,
+             'datum': datum,
+             'units': units,
+             'time_zone': time_zone,
+             'format': 'json',
+             'application': 'SI_2019_Coastal'}
+        if interval is not None:
+            p['interval'] = interval
+        params.append(p)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(lambda p: _get_chunk(session, url, p, product), params))
+
+    parts = [p for p in parts if p is not None]
+    if len(parts) == 0:
+        raise ValueError(f'No {product} data was found for station {station_id}')
+    data = pd.concat(parts).sort_index()
+    return data[~data.index.duplicated(keep='first')]
+
+
+harcon_url = 'https://api.tidesandcurrents.noaa.gov/mdapi/prod/webapi/stations/{}/harcon.json'
+
+
+def get_harcon(station_id, units='metric', session=None, url=harcon_url):
+    """
+    Returns: the harmonic constants published for the station as a frame of
+             name, amplitude, phase (deg, relative to Greenwich) and speed
+             (deg/hour); it is empty if the station has none.
+    """
+    import requests
+
+    r = (requests if session is None else session).get(url.format(station_id),
+                                                       params={'units': units}, timeout=60)
+    if r.status_code == 404:
+        return pd.DataFrame(columns=['name', 'amplitude', 'phase', 'speed'])
+    r.raise_for_status()
+    data = pd.DataFrame(r.json().get('HarmonicConstituents') or [],
+                        columns=['name', 'amplitude', 'phase_GMT', 'speed'])
+    data = data.rename(columns={'phase_GMT': 'phase'})
+    for c in ['amplitude', 'phase', 'speed']:
+        data[c] = pd.to_numeric(data[c], errors='coerce')
+    return data
+
+
+def get_harcons(station_ids, units='metric', workers=8, session=None, url=harcon_url):
+    """
+    Downloads the harmonic constants of many stations concurrently.
+    Returns: a frame of ID, name, amplitude, phase and speed rows; stations
+             without harmonic constants are left out.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from noaa_stations import make_session
+
+    station_ids = [str(s) for s in station_ids]
+    session = make_session(workers, retries=5) if session is None else session
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(lambda s: get_harcon(s, units, session, url), station_ids))
+
+    parts = [p.assign(ID=s) for s, p in zip(station_ids, parts) if len(p) > 0]
+    if len(parts) == 0:
+        raise ValueError('None of the stations has harmonic constants')
+    return pd.concat(parts, ignore_index=True)[['ID', 'name', 'amplitude', 'phase', 'speed']]
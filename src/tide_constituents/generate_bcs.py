@@ -1,70 +1,173 @@
-def generate_bc_files(gauge, year, coords=(None, None), gid=None):
+def generate_bc_files(gauge, year, coords=(None, None), gid=None, store=None, out_dir='.',
+                      synthesize=False, years=None):
+    """
+    Writes the D-Flow FM and GeoClaw boundary conditions of a water level or
+    discharge gauge for the given year. With synthesize=True the tide of the
+    lowest- and highest-range months is predicted locally from constituents
+    fitted to the downloaded year instead of being downloaded; the months are
+    then searched among the candidate years if any are given.
+    """
     import tide_constituents as tc
     import pandas as pd
     from calendar import monthrange
     import utils
     from metpy.units import units
+    from pathlib import Path
 
 
+    year = str(year)
     start = year + '0101'
     end = year + '1231'
     lon, lat = coords
 
     if gauge == 'water_level':
-        data = tc.get_water_levels(start, end, lon, lat, gid)
+        data = tc.get_water_levels(start, end, lon, lat, gid, store=store)
 
-        wl = data.water_level.copy()
-        grouped = wl.groupby(pd.Grouper(freq='M'))
-
-        def demeaner(group):
-            return pd.DataFrame({
-                'original': group,
-                'demeaned': group - group.mean()
-            })
-
-        wl_demeaned = grouped.apply(demeaner)
-
-        min_month = wl_demeaned.rolling(30).min().groupby(
-            pd.Grouper(freq='M')).last()
-        max_month = wl_demeaned.rolling(30).max().groupby(
-            pd.Grouper(freq='M')).last()
-
-        monthly_minmax = min_month.copy()
-        monthly_minmax['high'] = max_month['demeaned']
-        monthly_minmax = monthly_minmax[['demeaned', 'high']]
-        monthly_minmax.columns = ['low', 'high']
-        monthly_minmax['range'] = monthly_minmax.high - monthly_minmax.low
-        ranked = monthly_minmax.sort_values('range')
-
-        low, high = ranked.index[0], ranked.index[1]
+        if synthesize:
+            tide = tc.tide_constituents(data[data.water_level.notna()])
+        if synthesize and years is not None:
+            low, high = tc.scan_extreme_months(tide, years)
+        else:
+            low, high = tc.extreme_months(tc.monthly_ranges(data.water_level.astype('float')))
         for date, key in zip([low, high], ['low', 'high']):
             days = monthrange(date.year, date.month)[1]
             end = date
             start = end - pd.DateOffset(days - 1)
 
-            prediction = tc.get_tides(start.strftime('%Y%m%d'), end.strftime('%Y%m%d'), lon, lat)
+            if synthesize:
+                prediction = tc.synthesize(tide, start, end)
+            else:
+                prediction = tc.get_tides(start.strftime('%Y%m%d'), end.strftime('%Y%m%d'), lon, lat,
+                                          store=store)
             prediction['sec'] = prediction.index
             prediction['sec'] = prediction.sec.apply(lambda x: (
                 x - prediction.index[0]).total_seconds()).astype('int')
             prediction = prediction[['sec', 'predicted_wl']]
-            utils.write_wl_bc(prediction, key, 'dflow')
-            utils.write_wl_bc(prediction, key, 'geoclaw')
+            utils.write_wl_bc(prediction, key, 'dflow', out_dir)
+            utils.write_wl_bc(prediction, key, 'geoclaw', out_dir)
     elif gauge == 'discharge':
-        q = utils.get_discharge('gage_data', start, end, (lon, lat), gid)
+        q = utils.get_discharge(Path(Path(__file__).resolve().parent, 'gage_data'),
+                                start, end, (lon, lat), gid)
         q['sec'] = q.index
         q['sec'] = q.sec.apply(lambda x: (x - q.index[0]).total_seconds()).astype('int')
         q_range = [q.val.min(), q.val.mean(), q.val.max()]
         q_range = [(i * units('ft^3/s')).to_base_units().magnitude
                    for i in q_range]
         utils.write_q_bc(q.index[0], q.sec[0],
-                         q.sec[-1], q_range, 'dflow')
+                         q.sec[-1], q_range, 'dflow', out_dir)
         utils.write_q_bc(q.index[0], q.sec[0],
-                         q.sec[-1], q_range, 'geoclaw')
+                         q.sec[-1], q_range, 'geoclaw', out_dir)
     else:
         raise ValueError('gauge type could only be water_leve or discharge.')
 
+
+def generate_boundary_bcs(pli_files, start, end, crs=None, out_dir='.', freq='6min',
+                          k=4, power=2.0):
+    """
+    Writes out_dir/dflow/WaterLevel.bc with a tidal water level block for
+    every support point of the .pli boundaries between the start and end
+    days. The harmonic constants of the nearby CO-OPS stations are
+    interpolated to each point (see tide_constituents.boundary_forcing).
+    crs: the coordinate reference system of the .pli files (anything that
+         pyproj accepts) or a function mapping x, y to lon, lat; None if
+         they are already in lon/lat.
+    Returns: the forcing as a frame with one column per support point.
+    """
+    import tide_constituents as tc
+    import pandas as pd
+    import utils
+    from pathlib import Path
+
+    points = pd.concat([utils.read_pli(f) for f in pli_files], ignore_index=True)
+    if crs is None:
+        to_lonlat = lambda x, y: (x, y)
+    elif callable(crs):
+        to_lonlat = crs
+    else:
+        from pyproj import Transformer
+        to_lonlat = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True).transform
+    lon, lat = to_lonlat(points.x.values, points.y.values)
+
+    forcing = tc.boundary_forcing(lon, lat, points.name, start, end, freq, k, power)
+    utils.write_points_bc(forcing, Path(out_dir, 'dflow', 'WaterLevel.bc'))
+    return forcing
+
+
+def _run_job(job, out_dir, store_root):
+    import time
+    import traceback
+    from store import TimeSeriesStore
+
+    starttime = time.time()
+    try:
+        coords = (job.get('lon'), job.get('lat'))
+        synthesize = str(job.get('synthesize')).lower() in ['true', '1', 'yes']
+        years = job.get('years')
+        if years is not None and not isinstance(years, (list, tuple)):
+            years = str(years).replace(';', ' ').replace(',', ' ').split() or None
+        generate_bc_files(job['gauge'], job['year'], coords, job.get('gid'),
+                          TimeSeriesStore(store_root), out_dir, synthesize, years)
+        error = None
+    except Exception:
+        error = traceback.format_exc().strip().splitlines()[-1]
+    return time.time() - starttime, error
+
+
+def generate_batch(jobs, out_root='scenarios', workers=None, store_root='coops_store'):
+    """
+    Generates the boundary conditions of many stations and years in parallel.
+    jobs is a DataFrame (or the path to a CSV file) with the columns gauge,
+    year and either lon and lat or gid, and optionally name, synthesize and
+    years, the candidate years separated by spaces or semicolons (see
+    generate_bc_files). Each job writes
+    into out_root/name; all of them share the CO-OPS store in store_root.
+    Returns: a report of the time and error (if any) of every job, which is
+             also saved as out_root/report.csv.
+    """
+    import pandas as pd
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from pathlib import Path
+
+    jobs = pd.read_csv(jobs, dtype={'gid': str, 'year': str, 'years': str}) if isinstance(jobs, (str, Path)) else jobs.copy()
+    for c in ['lon', 'lat', 'gid', 'name']:
+        if c not in jobs:
+            jobs[c] = None
+    jobs = jobs.astype(object).where(jobs.notna(), None)
+    jobs['year'] = jobs.year.astype(str)
+    jobs['name'] = [n if n is not None else
+                    '_'.join([g, y, gid if gid is not None else f'{ln:.3f}_{lt:.3f}'])
+                    for n, g, y, gid, ln, lt in zip(jobs.name, jobs.gauge, jobs.year,
+                                                    jobs.gid, jobs.lon, jobs.lat)]
+
+    workers = multiprocessing.cpu_count() if workers is None else workers
+    print(f'Generating {len(jobs)} boundary condition sets with {workers} processes ...')
+    records = jobs.to_dict('records')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_job, job, Path(out_root, job['name']), store_root)
+                   for job in records]
+        results = [f.result() for f in futures]
+
+    report = jobs[['name', 'gauge', 'year']].copy()
+    report['seconds'] = [r[0] for r in results]
+    report['error'] = [r[1] for r in results]
+    Path(out_root).mkdir(parents=True, exist_ok=True)
+    report.to_csv(Path(out_root, 'report.csv'), index=False)
+    print(f'{report.error.isna().sum()} succeeded, {report.error.notna().sum()} failed '
+          + f'in {report.seconds.sum():.1f} seconds of work')
+    return report
+
 if __name__ == '__main__':
     from sys import argv
+    from store import TimeSeriesStore
+
+    if argv[1] == 'batch':
+        generate_batch(argv[2], workers=int(argv[3]) if len(argv) > 3 else None)
+        exit()
+    elif argv[1] == 'boundary':
+        generate_boundary_bcs(argv[5:], argv[2], argv[3],
+                              crs=None if argv[4].lower() == 'lonlat' else argv[4])
+        exit()
 
     gauge = argv[1]
     year = argv[2]
@@ -75,6 +178,8 @@ if __name__ == '__main__':
         coords = (None, None)
         gid = argv[3]
     else:
-        raise ValueError('3 or 4 arguments are required: gauge_type, year, [lon, lat], [station_id]')
+        raise ValueError('3 or 4 arguments are required: gauge_type, year, [lon, lat], [station_id] '
+                         + 'or batch, jobs.csv, [processes] '
+                         + 'or boundary, start, end, crs (or lonlat), boundary.pli, ...')
 
-    generate_bc_files(gauge, year, coords, gid)
\ No newline at end of file
+    generate_bc_files(gauge, year, coords, gid, TimeSeriesStore())
\ No newline at end of file
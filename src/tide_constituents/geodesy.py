@@ -0,0 +1,25 @@
+import numpy as np
+
+
+earth_radius = 6371.0088  # km
+
+
+def unit_vectors(lon, lat):
+    """Unit vectors (x, y, z) of points given in degrees; the chord between
+    two of them is a monotonic function of their great-circle distance, so
+    they can be indexed by a KD-tree."""
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+    return np.stack([np.cos(lat) * np.cos(lon),
+                     np.cos(lat) * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+
+def arc_length(chord):
+    """Great-circle distance (km) of a chord between unit vectors."""
+    return 2.0 * earth_radius * np.arcsin(np.minimum(chord / 2.0, 1.0))
+
+
+def chord_length(distance):
+    """Chord between unit vectors that are the great-circle distance (km)
+    apart."""
+    return 2.0 * np.sin(np.minimum(distance / earth_radius, np.pi) / 2.0)
@@ -1,6 +1,9 @@
 import pandas as pd
 
 
+base_url = 'https://tidesandcurrents.noaa.gov'
+
+
 def deg2float(old):
     direction = {'N':1, 'S':-1, 'E': 1, 'W':-1}
     new = old.replace(u'°',' ').replace('\'',' ')
@@ -9,47 +12,128 @@ def deg2float(old):
     return (float(new[0]) + float(new[1])/60.0) * direction[new_dir]
 
 
-def parse(url, tag):
+def make_session(workers=16, retries=3, session=None):
+    """A requests session (or the given one) with a connection pool sized for
+    the workers that retries failed requests with a backoff."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session() if session is None else session
+    adapter = HTTPAdapter(pool_connections=workers,
+                          pool_maxsize=workers,
+                          max_retries=Retry(total=retries,
+                                            backoff_factor=0.5,
+                                            status_forcelist=[500, 502, 503, 504]))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def parse(url, tag, session=None):
     import requests
     from bs4 import BeautifulSoup
 
-    r = requests.get(url)
+    r = (requests if session is None else session).get(url)
+    r.raise_for_status()
     soup = BeautifulSoup(r.content, 'html.parser')
     return soup.find_all(tag)
 
 
-def get_stations_id():
-    tags = parse('https://tidesandcurrents.noaa.gov/stations.html?type=Water%20Levels&sort=1', 'a')
+def get_stations_id(url=base_url, session=None):
+    import re
+
+
+    tags = parse(url + '/stations.html?type=Water%20Levels&sort=1', 'a', session)
     stations_id = []
 
     for t in tags:
         if t.has_attr('href'):
             if 'waterlevels.html?id' in t['href']:
                 stations_id.append(re.findall(r'\d+', t['href'])[0])
-    return stations_id
+    return list(dict.fromkeys(stations_id))
 
 
-def get_stations_info(stations_id):
-    import re
+def get_station_info(st, url=base_url, session=None):
+    """The ID, establishment date and location of a station, or None if its
+    page could not be fetched or parsed."""
+    info = {'ID': st}
+    try:
+        tags = parse(url + '/stationhome.html?id=' + st, 'td', session)
+    except Exception as e:
+        print(f'Station {st} failed: {e}')
+        return None
+    for i in range(len(tags)-1):
+        if len(tags[i].contents) == 0 or len(tags[i+1].contents) == 0:
+            continue
+        t = tags[i].contents[0]
+        if isinstance(t, str):
+            t = t.replace(':', '')
+            if t == 'Established':
+                info['Established'] = tags[i+1].contents[0]
+            elif t == 'Latitude' or t == 'Longitude':
+                try:
+                    info[t] = deg2float(tags[i+1].contents[0])
+                except Exception as e:
+                    print(f'Station {st} failed: {t} {e}')
+                    return None
+    return info
+
+
+def get_stations_info(stations_id, url=base_url, workers=16, session=None):
+    """Fetches the station pages concurrently with at most workers requests
+    in flight over a shared session.
+    Returns: a frame of the stations that were fetched and a list of the IDs
+             of those that failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+
+    session = make_session(workers) if session is None else session
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        info = list(executor.map(partial(get_station_info, url=url, session=session),
+                                 stations_id))
+    failed = [st for st, i in zip(stations_id, info) if i is None]
+    info = [i for i in info if i is not None]
+    return pd.DataFrame(info, columns=['ID', 'Established', 'Longitude', 'Latitude']), failed
+
+
+def update_catalog(fname='noaa_stations.csv', url=base_url, workers=16, refresh=False):
+    """
+    Brings the station catalog in fname up to date. Only the stations that
+    are not in the catalog yet, or whose location is missing, are fetched;
+    stations that are no longer listed are dropped. refresh=True rebuilds the
+    whole catalog. Stations that fail to download keep their previous row, if
+    any, and are left out otherwise.
+    Returns: the catalog and the IDs of the stations that failed.
+    """
+    from pathlib import Path
+
+    session = make_session(workers)
+    stations_id = get_stations_id(url, session)
+
+    if Path(fname).exists():
+        previous = pd.read_csv(fname, dtype={'ID': str})
+        previous = previous[previous.ID.isin(stations_id)]
+    else:
+        previous = pd.DataFrame(columns=['ID', 'Established', 'Longitude', 'Latitude'])
+    if refresh:
+        old = previous.iloc[:0]
+    else:
+        old = previous[previous[['Longitude', 'Latitude']].notna().all(axis=1)]
+
+    known = set(old.ID)
+    new_id = [st for st in stations_id if st not in known]
+    new, failed = get_stations_info(new_id, url, workers, session)
+    print(f'{len(new_id) - len(failed)} stations fetched, {len(old)} reused, {len(failed)} failed.')
+
+    df = pd.concat([old, new, previous[previous.ID.isin(failed)]], ignore_index=True)
+    df = df.set_index('ID').reindex([st for st in stations_id if st in set(df.ID)]).reset_index()
+    df.to_csv(fname, index=False)
+    return df, failed
+
 
+if __name__ == '__main__':
+    from sys import argv
 
-    established, lats, lons = [], [], []
-    for st in stations_id:
-        tags = parse('https://tidesandcurrents.noaa.gov/stationhome.html?id=' + st, 'td')
-        for i in range(len(tags)-1):
-            t = tags[i].contents[0]
-            if isinstance(t, str):
-                t = t.replace(':', '')
-                if t == 'Established':
-                    established.append(tags[i+1].contents[0])
-                elif t == 'Latitude':
-                    lats.append(deg2float(tags[i+1].contents[0]))
-                elif t == 'Longitude':
-                    lons.append(deg2float(tags[i+1].contents[0]))
-    return established, lats, lons
-
-
-stations_id = get_stations_id()
-established, lats, lons = get_stations_info(stations_id)
-df = pd.DataFrame({'ID': stations_id, 'Established': established, 'Longitude':lons, 'Latitude':lats})
-df.to_csv('noaa_stations.csv', index=False)
+    update_catalog(refresh=len(argv) > 1 and argv[1] == '--refresh')
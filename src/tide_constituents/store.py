@@ -0,0 +1,147 @@
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+import pandas as pd
+
+
+def _tmp_name(fname):
+    """A new temporary file next to fname, unique to the caller."""
+    fd, tmp = tempfile.mkstemp(dir=Path(fname).parent, prefix=Path(fname).name, suffix='.tmp')
+    os.close(fd)
+    return tmp
+
+
+@contextmanager
+def _locked(path):
+    """Holds an exclusive lock on the directory; it is released when the
+    lock file is closed, also if the caller fails."""
+    import fcntl
+
+    with open(Path(path, '.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+class TimeSeriesStore():
+    """
+    Local Parquet store of CO-OPS time series. Each station, product, datum
+    and interval has its own directory with one partition per year and a
+    coverage.json file listing the (inclusive) day ranges that have already
+    been downloaded, so only the missing sub-ranges of a request are fetched.
+    Requests for the same directory are serialized with a file lock so that
+    several processes can share a store.
+    """
+    def __init__(self, root='coops_store'):
+        self.root = Path(root)
+
+    def path(self, station_id, product, datum='MSL', interval=None):
+        interval = '6min' if interval is None else interval
+        return Path(self.root, str(station_id), f'{product}_{datum}_{interval}')
+
+    @staticmethod
+    def _day(date):
+        return pd.to_datetime(date).normalize()
+
+    def coverage(self, path):
+        fname = Path(path, 'coverage.json')
+        if not fname.exists():
+            return []
+        with open(fname, 'r') as f:
+            return [(pd.Timestamp(s), pd.Timestamp(e)) for s, e in json.load(f)]
+
+    def _set_coverage(self, path, ranges):
+        day = pd.Timedelta(days=1)
+        merged = []
+        for s, e in sorted(ranges):
+            if merged and s <= merged[-1][1] + day:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+            else:
+                merged.append((s, e))
+        fname = Path(path, 'coverage.json')
+        tmp = _tmp_name(fname)
+        with open(tmp, 'w') as f:
+            json.dump([(str(s.date()), str(e.date())) for s, e in merged], f)
+        os.replace(tmp, fname)
+
+    def missing(self, path, start, end):
+        """Returns: the day ranges between start and end that are not stored."""
+        day = pd.Timedelta(days=1)
+        start, end = self._day(start), self._day(end)
+        gaps, current = [], start
+        for s, e in sorted(self.coverage(path)):
+            if e < current:
+                continue
+            if s > end:
+                break
+            if s > current:
+                gaps.append((current, s - day))
+            current = max(current, e + day)
+        if current <= end:
+            gaps.append((current, end))
+        return gaps
+
+    def _covered(self, data, start, end):
+        """
+        Returns: the last day of start..end that the fetched data accounts
+                 for, or None. Days after the last returned sample are not
+                 covered (the day of that sample only if the data reach the
+                 end of the range), and neither is any day after yesterday
+                 (UTC) since it can still change.
+        """
+        if data is None or len(data) == 0:
+            return None
+        day = pd.Timedelta(days=1)
+        last = data.index.max()
+        last = self._day(last if last.tz is None else last.tz_convert(None))
+        covered = end if last >= end else last - day
+        covered = min(covered, pd.Timestamp.now(tz='UTC').tz_localize(None).normalize() - day)
+        return covered if covered >= start else None
+
+    def _merge(self, path, data):
+        if len(data) == 0:
+            return
+        data = data[~data.index.duplicated(keep='last')].sort_index()
+        for year, part in data.groupby(data.index.year):
+            fname = Path(path, f'{year}.parquet')
+            if fname.exists():
+                part = pd.concat([pd.read_parquet(fname), part])
+                part = part[~part.index.duplicated(keep='last')].sort_index()
+            tmp = _tmp_name(fname)
+            part.to_parquet(tmp)
+            os.replace(tmp, fname)
+
+    def read(self, path, start, end):
+        start, end = self._day(start), self._day(end) + pd.Timedelta(days=1)
+        parts = [pd.read_parquet(Path(path, f'{y}.parquet'))
+                 for y in range(start.year, end.year + 1)
+                 if Path(path, f'{y}.parquet').exists()]
+        if len(parts) == 0:
+            return pd.DataFrame()
+        data = pd.concat(parts)
+        return data[(data.index >= start) & (data.index < end)]
+
+    def get(self, station_id, product, start, end, fetch, datum='MSL', interval=None):
+        """
+        Returns the stored series between the start and end days (inclusive)
+        after calling fetch(start, end) for each missing sub-range, where
+        fetch returns a DataFrame indexed by date for those (inclusive) days.
+        Only the days up to the last returned sample (and at most yesterday)
+        are marked as stored, so the rest is fetched again next time.
+        """
+        path = self.path(station_id, product, datum, interval)
+        path.mkdir(parents=True, exist_ok=True)
+
+        with _locked(path):
+            covered = []
+            for s, e in self.missing(path, start, end):
+                data = fetch(s, e)
+                self._merge(path, data)
+                last = self._covered(data, s, e)
+                if last is not None:
+                    covered.append((s, last))
+            if len(covered) > 0:
+                self._set_coverage(path, self.coverage(path) + covered)
+
+            return self.read(path, start, end)
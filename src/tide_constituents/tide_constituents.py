@@ -1,76 +1,125 @@
 import pandas as pd
 import numpy as np
-from shapely.ops import nearest_points
-from shapely.geometry import Point, MultiPoint
-import noaa_coops as nc
+import os
 from tappy import tappy
+import coops
+from astronomic_cache import AstronomicCache
+from geodesy import unit_vectors, arc_length, chord_length
 
 
-def get_tides(start, end, lon, lat, interval=None):
-    """
-    date format: YYYYDDMM
-    Returns: phase, amplitude
-    """
-    stations = pd.read_csv('noaa_stations.csv', parse_dates=[1])
-    coords = [Point(ln, lt) for ln, lt in zip(stations.Longitude, stations.Latitude)]
-    nearest_station_loc = nearest_points(Point(lon, lat), MultiPoint(coords))[1]
-    idx = coords.index(nearest_station_loc)
-
-    station = nc.Station(stations.iloc[idx].ID)
-    if interval == None:
-        noaa_predict = station.get_data(
-            begin_date=start,
-            end_date=end,
-            product="predictions",
-            datum="MSL",
-            units="metric",
-            time_zone="gmt")
-    elif interval == 'h' or interval == 'hilo':
-        noaa_predict = station.get_data(
-            begin_date=start,
-            end_date=end,
-            product="predictions",
-            datum="MSL",
-            interval=interval,
-            units="metric",
-            time_zone="gmt")
-    else:
+class StationCatalog():
+    """
+    NOAA stations of noaa_stations.csv (or of a frame with the same ID,
+    Longitude and Latitude columns) indexed by a KD-tree on their unit
+    vectors so that nearest and radius queries are geodesic and can be done
+    for many points at once.
+    """
+    def __init__(self, fname='noaa_stations.csv'):
+        from scipy.spatial import cKDTree
+
+        if isinstance(fname, pd.DataFrame):
+            self.stations = fname.reset_index(drop=True)
+        else:
+            self.stations = pd.read_csv(fname, parse_dates=[1])
+        self.tree = cKDTree(unit_vectors(self.stations.Longitude.values,
+                                         self.stations.Latitude.values))
+
+    def nearest(self, lon, lat, k=1):
+        """
+        Returns: IDs and great-circle distances (km) of the k nearest stations
+                 to each point; shape is that of lon (and lat) plus k if k > 1.
+        """
+        chord, idx = self.tree.query(unit_vectors(lon, lat), k=k)
+        return (self.stations.ID.to_numpy()[idx],
+                arc_length(chord))
+
+    def within(self, lon, lat, radius):
+        """
+        Returns: IDs of the stations within radius (km) of the point, or a
+                 list of them for each point if arrays are given.
+        """
+        chord = chord_length(radius)
+        idx = self.tree.query_ball_point(unit_vectors(lon, lat), chord)
+        if np.ndim(lon) == 0:
+            return self.stations.ID.to_numpy()[sorted(idx)]
+        return [self.stations.ID.to_numpy()[sorted(i)] for i in np.ravel(idx)]
+
+
+_catalogs = {}
+
+
+def get_catalog(fname='noaa_stations.csv'):
+    """A StationCatalog shared between calls until the file changes."""
+    key = (os.path.abspath(fname), os.path.getmtime(fname))
+    if key not in _catalogs:
+        _catalogs.clear()
+        _catalogs[key] = StationCatalog(fname)
+    return _catalogs[key]
+
+
+def get_tides(start, end, lon, lat, interval=None, store=None):
+    """
+    date format: YYYYMMDD
+    store: an optional store.TimeSeriesStore; only the days missing from it
+           are downloaded.
+    Returns: predicted water levels
+    """
+    station_id = str(get_catalog().nearest(lon, lat)[0])
+    if interval not in [None, 'h', 'hilo']:
         raise KeyError('interval can only be h (hourly) or hilo (high and low) or None (6 min)')
+
+    def fetch(start, end):
+        return coops.get_data(station_id, start, end,
+                              product="predictions",
+                              datum="MSL",
+                              interval=interval)
+
+    if store is None:
+        noaa_predict = fetch(start, end)
+    else:
+        noaa_predict = store.get(station_id, 'predictions', start, end, fetch,
+                                 datum='MSL', interval=interval)
         
     noaa_predict['predicted_wl'] =  noaa_predict.predicted_wl.astype('float')
 
     return noaa_predict
 
 
-def get_water_levels(start, end, lon, lat, station_id=None):
+def get_water_levels(start, end, lon, lat, station_id=None, store=None):
     """
-    date format: YYYYDDMM
-    Returns: phase, amplitude
+    date format: YYYYMMDD
+    store: an optional store.TimeSeriesStore; only the days missing from it
+           are downloaded.
+    Returns: hourly observed water levels
     """
     if station_id == None:
-        stations = pd.read_csv('noaa_stations.csv', parse_dates=[1])
-        coords = [Point(ln, lt) for ln, lt in zip(stations.Longitude, stations.Latitude)]
-        nearest_station_loc = nearest_points(Point(lon, lat), MultiPoint(coords))[1]
-        idx = coords.index(nearest_station_loc)
-        station_id = stations.iloc[idx].ID
-
-    station = nc.Station(str(station_id))
-    water_levels = station.get_data(
-        begin_date=start,
-        end_date=end,
-        product="water_level",
-        datum="MSL",
-        interval="h",
-        units="metric",
-        time_zone="gmt")
+        station_id = get_catalog().nearest(lon, lat)[0]
+
+    def fetch(start, end):
+        return coops.get_data(station_id, start, end,
+                              product="water_level",
+                              datum="MSL",
+                              interval="h")
+
+    if store is None:
+        water_levels = fetch(start, end)
+    else:
+        water_levels = store.get(str(station_id), 'water_level', start, end, fetch,
+                                 datum='MSL', interval='h')
     
     return water_levels
 
-def tide_constituents(water_levels):
-    
-    dates = pd.to_datetime(water_levels.index) # a datetime.datetime list of dates
-    elevation = water_levels.water_level.astype('float') # a list of surface elevation values
 
+astro_cache = AstronomicCache()
+
+
+def astronomic(dates, rayleigh=1.0, cache=None):
+    """
+    A tappy object set up for the dates with their astronomic arguments,
+    constituent selection, speeds, equilibrium arguments (VAU) and nodal
+    factors (FF), but no elevations. rayleigh=0 selects all the constituents
+    regardless of the record length (for synthesis rather than analysis).
+    """
     # Set up the bits needed for TAPPY. This is mostly lifted from
     # tappy.py in the baker function "analysis" (around line 1721).
     quiet = True
@@ -78,7 +127,6 @@ def tide_constituents(water_levels):
     outputts = False
     outputxml = False
     ephemeris = False
-    rayleigh = 1.0
     print_vau_table = False
     missing_data = 'ignore'
     linear_trend = False
@@ -88,8 +136,10 @@ def tide_constituents(water_levels):
     pad_filters = None
     include_inferred = True
 
-    if rayleigh:
-        ray = float(rayleigh)
+    ray = float(rayleigh) if rayleigh else 0.0
+
+    if cache is None:
+        cache = astro_cache
 
     x = tappy.tappy(
         outputts = outputts,
@@ -108,12 +158,16 @@ def tide_constituents(water_levels):
         include_inferred=include_inferred,
         )
 
-    x.dates = dates
-    x.elevation = elevation
-    package = x.astronomic(x.dates)
+    x.dates = pd.to_datetime(dates)
+    package, (x.speed_dict, x.key_list) = cache.load(x, ray)
     (x.zeta, x.nu, x.nup, x.nupp, x.kap_p, x.ii, x.R, x.Q, x.T, x.jd, x.s, x.h, x.N, x.p, x.p1) = package
-    (x.speed_dict, x.key_list) = x.which_constituents(len(x.dates),
-            package, rayleigh_comp=ray)
+    return x
+
+
+def tide_constituents(water_levels, cache=None):
+    
+    x = astronomic(water_levels.index, cache=cache) # a datetime.datetime list of dates
+    x.elevation = water_levels.water_level.astype('float') # a list of surface elevation values
 
     # the analysis
     x.constituents()
@@ -121,23 +175,243 @@ def tide_constituents(water_levels):
     return x
 
 
+def julian_hours(dates, epoch=None):
+    """
+    Hours elapsed from epoch (the first date by default) for an array-like
+    of dates; timezone-aware dates are converted to UTC.
+    """
+    t = pd.DatetimeIndex(pd.to_datetime(dates))
+    if t.tz is not None:
+        t = t.tz_convert(None)
+    t = t.values.astype('datetime64[ns]')
+    if epoch is None:
+        t0 = t[0]
+    else:
+        t0 = pd.Timestamp(epoch)
+        t0 = np.datetime64(t0 if t0.tz is None else t0.tz_convert(None), 'ns')
+    return (t - t0) / np.timedelta64(1, 'h')
+
+
+def predict(hours, constituents, speed_dict, amp, phase, nodal=False):
+    """
+    Evaluates the tidal signal of the constituents at the given hours.
+    amp and phase (deg) map each constituent to either a scalar or an array
+    over stations/nodes; all of them are evaluated at once as a matrix
+    product and the result has shape (time,) or (time, stations).
+    Nodal factors (FF) are only applied if nodal is True.
+    """
+    hours = np.asarray(hours, dtype=np.float64)
+    constituents = list(constituents)
+    if len(constituents) == 0:
+        return np.zeros(hours.shape + np.shape(amp.get('Z0', 0.0)))
+
+    deg2rad = np.pi / 180.0
+    speed = np.array([speed_dict[i]['speed'] for i in constituents])
+    vau = np.array([speed_dict[i]['VAU'] for i in constituents])
+    arg = np.outer(hours, speed) + vau * deg2rad
+    cos_arg, sin_arg = np.cos(arg), np.sin(arg)
+    if nodal:
+        ff = np.column_stack([
+            np.broadcast_to(speed_dict[i]['FF'], hours.shape)
+            for i in constituents
+        ])
+        cos_arg *= ff
+        sin_arg *= ff
+
+    a = np.array([np.asarray(amp[i], dtype=np.float64) for i in constituents])
+    g = np.array([np.asarray(phase[i], dtype=np.float64)
+                  for i in constituents]) * deg2rad
+    return cos_arg @ (a * np.cos(g)) + sin_arg @ (a * np.sin(g))
+
+
 def sum_signals(constituents, hours, speed_dict, amp, phase):
-    import astronomia.calendar as cal
+    return predict(julian_hours(hours), constituents, speed_dict, amp, phase)
+
+
+def monthly_ranges(water_levels):
+    """
+    Demeaned monthly low, high and range of water levels given either as a
+    series or as a frame with one column per station. Removing the monthly
+    mean only shifts a month, so they follow from its min, max and mean.
+    Returns: a frame indexed by month end with low, high and range columns,
+             or with (low/high/range, station) columns for a frame.
+    """
+    grouped = water_levels.groupby(pd.Grouper(freq=pd.offsets.MonthEnd()))
+    mean, low, high = grouped.mean(), grouped.min(), grouped.max()
+    return pd.concat({'low': low - mean, 'high': high - mean, 'range': high - low}, axis=1)
+
 
+def extreme_months(ranges):
+    """Returns: the months with the smallest and the largest tidal range
+                (for every station if ranges has one column per station)."""
+    return ranges['range'].idxmin(), ranges['range'].idxmax()
 
-    jd = [cal.cal_to_jd(i.year, i.month, i.day) + cal.hms_to_fday(i.hour, i.minute, i.second) for i in hours]
-    hours = np.array(jd).flatten()
-    hours = (hours - hours[0]) * 24.0
-    total = np.zeros(len(hours), dtype=np.float64)
 
-    deg2rad = np.pi/180.0
-    for i in constituents:
-        speed_dict[i]['FF'] = np.ones_like(speed_dict[i]['FF'])
-        total = total + amp[i] * speed_dict[i]['FF'] * np.cos(speed_dict[i]['speed'] * hours - (phase[i] - speed_dict[i]['VAU']) * deg2rad)
-    return total
+# Speed (deg/hour) of the major constituents used to size analysis windows
+major_speeds = {'M2': 28.9841042, 'S2': 30.0, 'N2': 28.4397295,
+                'K1': 15.0410686, 'O1': 13.9430356}
 
 
-def wl_prediction(data, start, end, interval=1):
+def rayleigh_window(speeds=None, rayleigh=1.0):
+    """
+    Shortest record that separates the given constituent speeds (deg/hour)
+    according to the Rayleigh criterion.
+    """
+    speeds = np.sort(list((major_speeds if speeds is None else speeds).values()))
+    return pd.Timedelta(hours=rayleigh * 360.0 / np.diff(speeds).min())
+
+
+def _predict_fit(tide, dates):
+    prediction = 0.0 if 'Z0' not in list(tide.speed_dict.keys()) else tide.speed_dict['Z0']
+    hours = julian_hours(dates, epoch=tide.dates[0])
+    return prediction + predict(hours, tide.key_list, tide.speed_dict, tide.r, tide.phase)
+
+
+def synthesize(tide, start, end, freq='6min'):
+    """
+    Tidal prediction of a fitted tappy object for the days between start
+    and end (inclusive) at the given frequency, with the same layout as
+    get_tides. The equilibrium arguments and nodal factors are those of the
+    synthesis dates rather than of the fit, so that the amplitudes fitted
+    with nodal factors are reproduced in any year.
+    """
+    dates = pd.date_range(pd.Timestamp(start).normalize(),
+                          pd.Timestamp(end).normalize() + pd.Timedelta(days=1),
+                          freq=freq)[:-1]
+    dates.name = 'date_time'
+    x = astronomic(dates, rayleigh=0)
+    prediction = 0.0 if 'Z0' not in list(tide.speed_dict.keys()) else tide.speed_dict['Z0']
+    prediction = prediction + predict(julian_hours(dates), tide.key_list, x.speed_dict,
+                                      tide.r, tide.phase, nodal=True)
+    return pd.DataFrame({'predicted_wl': prediction}, index=dates)
+
+
+def scan_extreme_months(tide, years, freq='h'):
+    """
+    Synthesizes the tide of all the candidate years in one pass and returns
+    the months with the smallest and the largest tidal range among them.
+    """
+    years = sorted(int(y) for y in years)
+    prediction = synthesize(tide, f'{years[0]}0101', f'{years[-1]}1231', freq)
+    prediction = prediction[prediction.index.year.isin(years)]
+    return extreme_months(monthly_ranges(prediction.predicted_wl))
+
+
+def interpolate_constituents(lon, lat, harcon, stations, k=4, power=2.0):
+    """
+    Interpolates the harmonic constants of the stations to the points by
+    inverse great-circle distance weighting of their k nearest stations.
+    Amplitude and phase are combined as amp * exp(i * phase) before
+    averaging so that phases near 0/360 deg are not averaged across the wrap.
+    harcon: a frame of ID, name, amplitude and phase (deg) rows as returned
+            by coops.get_harcons; constituents missing at a station count
+            as zero.
+    stations: a frame with the ID, Longitude and Latitude of the stations.
+    Returns: amplitude and phase (deg) dictionaries of constituent name to
+             an array over the points.
+    """
+    harcon = harcon.assign(ID=harcon.ID.astype(str))
+    amp = harcon.pivot_table(index='ID', columns='name', values='amplitude').fillna(0.0)
+    phase = harcon.pivot_table(index='ID', columns='name', values='phase').fillna(0.0)
+    z = amp.values * np.exp(1j * np.deg2rad(phase.values))
+
+    stations = stations.assign(ID=stations.ID.astype(str))
+    stations = stations[stations.ID.isin(amp.index)].drop_duplicates('ID')
+    if len(stations) == 0:
+        raise ValueError('None of the stations has harmonic constants')
+    k = min(k, len(stations))
+
+    lon, lat = np.atleast_1d(lon), np.atleast_1d(lat)
+    ids, dist = StationCatalog(stations).nearest(lon, lat, k)
+    ids, dist = ids.reshape(len(lon), k), dist.reshape(len(lon), k)
+
+    with np.errstate(divide='ignore'):
+        w = 1.0 / dist**power
+    exact = np.isinf(w).any(axis=1)
+    w[exact] = np.isinf(w[exact])
+    w /= w.sum(axis=1, keepdims=True)
+
+    zp = np.einsum('pk,pkc->pc', w, z[amp.index.get_indexer(ids.ravel())].reshape(len(lon), k, -1))
+    return ({c: np.abs(zp[:, i]) for i, c in enumerate(amp.columns)},
+            {c: np.rad2deg(np.angle(zp[:, i])) % 360.0 for i, c in enumerate(amp.columns)})
+
+
+# CO-OPS names of the constituents that tappy names differently
+coops_names = {'NU2': 'nu2', 'MU2': 'mu2', 'LAM2': 'lambda2', 'RHO': 'rho1',
+               'MM': 'Mm', 'MF': 'Mf', 'MSF': 'MSf', 'SA': 'Sa', 'SSA': 'Ssa',
+               '2MK3': 'MO3'}
+
+
+def boundary_forcing(lon, lat, names, start, end, freq='6min', k=4, power=2.0,
+                     catalog=None, workers=8):
+    """
+    Tidal water levels at many boundary support points between the start and
+    end days (inclusive). The harmonic constants of the stations nearest to
+    the points are downloaded once (not per point), interpolated to every
+    point (see interpolate_constituents) and all the points are predicted in
+    a single matrix product with the nodal factors of the forcing period.
+    All the published constituents are used whatever the length of the
+    period since no fit is involved; those unknown to tappy are skipped
+    with a warning.
+    Returns: a frame indexed by date_time with one column per point name.
+    """
+    catalog = get_catalog() if catalog is None else catalog
+    candidates = np.unique(catalog.nearest(lon, lat, min(2 * k, len(catalog.stations)))[0])
+    harcon = coops.get_harcons(candidates, workers=workers)
+    amp, phase = interpolate_constituents(lon, lat, harcon, catalog.stations, k, power)
+
+    dates = pd.date_range(pd.Timestamp(start).normalize(),
+                          pd.Timestamp(end).normalize() + pd.Timedelta(days=1),
+                          freq=freq)
+    dates.name = 'date_time'
+    x = astronomic(dates, rayleigh=0)
+    amp = {coops_names.get(c, c): a for c, a in amp.items()}
+    phase = {coops_names.get(c, c): p for c, p in phase.items()}
+    constituents = [c for c in amp if c in x.speed_dict]
+    missing = [c for c in amp if c not in x.speed_dict]
+    if len(missing) > 0:
+        import warnings
+        warnings.warn('Constituents without a tappy equivalent are left out: '
+                      + ', '.join(missing))
+    wl = predict(julian_hours(dates), constituents, x.speed_dict, amp, phase, nodal=True)
+    return pd.DataFrame(wl, index=dates, columns=list(names))
+
+
+def wl_prediction(data, start, end, interval=1, mode='interval', window=None):
+    """
+    Predicts the tide between start and end from the observed water levels.
+    mode:
+        interval: refits every interval days (the last sample is dropped)
+        single: fits once over the whole record and predicts in one pass
+        window: fits overlapping windows of length window (by default the
+                Rayleigh window of the major constituents) with half a window
+                overlap; each sample is predicted by the window centred closest
+                to it.
+    """
+    if mode == 'single':
+        obs = data.loc[start:end]
+        tide = tide_constituents(obs)
+        return pd.DataFrame({'prediction': _predict_fit(tide, obs.index)}, index=obs.index)
+    elif mode == 'window':
+        obs = data.loc[start:end]
+        window = rayleigh_window() if window is None else pd.Timedelta(window)
+        step = window / 2
+        first, last = obs.index[0], obs.index[-1]
+        starts = [first]
+        while starts[-1] + window < last:
+            starts.append(starts[-1] + step)
+
+        p = np.empty(len(obs))
+        for k, s in enumerate(starts):
+            lo = first if k == 0 else s + step / 2
+            hi = last + step if k == len(starts) - 1 else s + step * 3 / 2
+            rows = (obs.index >= lo) & (obs.index < hi)
+            tide = tide_constituents(obs.loc[s:s + window])
+            p[rows] = _predict_fit(tide, obs.index[rows])
+        return pd.DataFrame({'prediction': p}, index=obs.index)
+    elif mode != 'interval':
+        raise KeyError('mode can only be interval, single or window')
+
     d = start
     p =  []
     
@@ -146,9 +420,132 @@ def wl_prediction(data, start, end, interval=1):
         end_ = start_ + pd.DateOffset(interval)
         end_ = end_ if end_ < end else end
         tide = tide_constituents(data.loc[start_:end_])
-        prediction = 0.0 if 'Z0' not in list(tide.speed_dict.keys()) else tide.speed_dict['Z0']
-        prediction += sum_signals(tide.key_list, tide.dates, tide.speed_dict, tide.r, tide.phase)
+        prediction = _predict_fit(tide, tide.dates)
         p.append(prediction[:-1])
         d = end_
 
     return pd.DataFrame({'prediction': np.hstack(p)}, index=data.loc[start:end].index[:-1])
+
+
+def _utc(date):
+    date = pd.Timestamp(date)
+    return date if date.tz is None else date.tz_convert(None)
+
+
+class OnlineHarmonics():
+    """
+    Incremental harmonic analysis of a water level record. The normal
+    equations of the least-squares fit are accumulated batch by batch so each
+    update costs O(batch) regardless of how much data has been ingested.
+    The constituents, their speeds and equilibrium arguments come from a
+    tappy analysis of an initial record whose first date is the epoch of all
+    the phases; nodal factors are held at their mean over that record.
+    Samples that are not newer than the last ingested one are ignored, so
+    overlapping refreshes can be passed as they are.
+    """
+    def __init__(self, epoch, key_list, speed, vau, ff):
+        self.epoch = _utc(epoch)
+        self.key_list = list(key_list)
+        self.speed = np.asarray(speed, dtype=np.float64)
+        self.vau = np.asarray(vau, dtype=np.float64)
+        self.ff = np.asarray(ff, dtype=np.float64)
+
+        n = 1 + 2 * len(self.key_list)
+        self.ata = np.zeros((n, n))
+        self.aty = np.zeros(n)
+        self.count = 0
+        self.last = None
+
+    @classmethod
+    def from_record(cls, water_levels, cache=None):
+        tide = tide_constituents(water_levels, cache)
+        keys = [k for k in tide.key_list if k in tide.speed_dict]
+        online = cls(tide.dates[0], keys,
+                     [tide.speed_dict[k]['speed'] for k in keys],
+                     [tide.speed_dict[k]['VAU'] for k in keys],
+                     [np.mean(tide.speed_dict[k]['FF']) for k in keys])
+        online.update(water_levels)
+        return online
+
+    @property
+    def speed_dict(self):
+        return {k: {'speed': s, 'VAU': v, 'FF': f}
+                for k, s, v, f in zip(self.key_list, self.speed, self.vau, self.ff)}
+
+    def _design(self, hours):
+        deg2rad = np.pi / 180.0
+        arg = np.outer(hours, self.speed) + self.vau * deg2rad
+        a = np.empty((len(hours), 1 + 2 * len(self.key_list)))
+        a[:, 0] = 1.0
+        a[:, 1::2] = self.ff * np.cos(arg)
+        a[:, 2::2] = self.ff * np.sin(arg)
+        return a
+
+    def update(self, water_levels):
+        """Ingests a batch of observations (a series or a frame with a
+        water_level column indexed by date)."""
+        if isinstance(water_levels, pd.DataFrame):
+            water_levels = water_levels.water_level
+        wl = water_levels.astype('float').dropna().sort_index()
+        if wl.index.tz is not None:
+            wl.index = wl.index.tz_convert(None)
+        if self.last is not None:
+            wl = wl[wl.index > self.last]
+        if len(wl) == 0:
+            return self
+
+        a = self._design(julian_hours(wl.index, epoch=self.epoch))
+        y = wl.values
+        self.ata += a.T @ a
+        self.aty += a.T @ y
+        self.count += len(y)
+        self.last = wl.index[-1]
+        return self
+
+    def coefficients(self):
+        return np.linalg.lstsq(self.ata, self.aty, rcond=None)[0]
+
+    def constituents(self):
+        """Returns: mean level and the amplitude and phase (deg) dictionaries."""
+        coef = self.coefficients()
+        c, s = coef[1::2], coef[2::2]
+        r = dict(zip(self.key_list, np.hypot(c, s)))
+        phase = dict(zip(self.key_list, np.rad2deg(np.arctan2(s, c)) % 360.0))
+        return coef[0], r, phase
+
+    def predict(self, dates):
+        z0, r, phase = self.constituents()
+        hours = julian_hours(dates, epoch=self.epoch)
+        return z0 + predict(hours, self.key_list, self.speed_dict, r, phase, nodal=True)
+
+    def save(self, fname):
+        """
+        Checkpoints the accumulated state to fname (in npz format, under the
+        given name). It is written to a temporary file first, so a crash
+        while saving leaves the previous checkpoint intact.
+        """
+        from store import _tmp_name
+
+        tmp = _tmp_name(fname)
+        with open(tmp, 'wb') as f:
+            np.savez(f,
+                     epoch=np.datetime64(self.epoch, 'ns'),
+                     key_list=np.array(self.key_list),
+                     speed=self.speed,
+                     vau=self.vau,
+                     ff=self.ff,
+                     ata=self.ata,
+                     aty=self.aty,
+                     count=self.count,
+                     last=np.datetime64('NaT' if self.last is None else self.last, 'ns'))
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as f:
+            online = cls(f['epoch'][()], f['key_list'].tolist(), f['speed'], f['vau'], f['ff'])
+            online.ata = f['ata']
+            online.aty = f['aty']
+            online.count = int(f['count'])
+            online.last = None if np.isnat(f['last']) else pd.Timestamp(f['last'][()])
+        return online
@@ -1,11 +1,56 @@
 import numpy as np
 import pandas as pd
 from pathlib import Path
-import fileinput
-import shutil
 import os
 
 
+_gage_indices = {}
+
+
+def gage_index(gis_dir):
+    """
+    Gauge IDs and locations of NHDPlus GageLoc.shp with a KD-tree on their
+    unit vectors. The shapefile is parsed only once; its IDs and coordinates
+    are cached in GageLoc.parquet next to it (rebuilt when the shapefile is
+    newer) and the index is kept in memory for later calls.
+    """
+    from scipy.spatial import cKDTree
+    from geodesy import unit_vectors
+
+    loc_path = Path(gis_dir, 'GageLoc.shp')
+    cache = Path(gis_dir, 'GageLoc.parquet')
+    if not loc_path.exists() and not cache.exists():
+        raise FileNotFoundError('GageLoc.shp cannot be found in ' +
+                                str(gis_dir))
+
+    if not cache.exists() or (loc_path.exists() and
+                              loc_path.stat().st_mtime > cache.stat().st_mtime):
+        import geopandas as gpd
+
+        gloc = gpd.read_file(loc_path)
+        pd.DataFrame({'SOURCE_FEA': gloc.SOURCE_FEA.astype('str').values,
+                      'lon': gloc.geometry.x.values,
+                      'lat': gloc.geometry.y.values}).to_parquet(cache)
+
+    key = (str(cache.resolve()), cache.stat().st_mtime)
+    if key not in _gage_indices:
+        gages = pd.read_parquet(cache)
+        _gage_indices[key] = (gages, cKDTree(unit_vectors(gages.lon.values, gages.lat.values)))
+    return _gage_indices[key]
+
+
+def nearest_gauges(gis_dir, lon, lat, k=1):
+    """
+    Returns: IDs and great-circle distances (km) of the k nearest gauges of
+             GageLoc to each of the given points (scalars or arrays).
+    """
+    from geodesy import unit_vectors, arc_length
+
+    gages, tree = gage_index(gis_dir)
+    chord, idx = tree.query(unit_vectors(lon, lat), k=k)
+    return gages.SOURCE_FEA.to_numpy()[idx], arc_length(chord)
+
+
 def get_discharge(gis_dir, start, end, coords, station_id=None):
     '''Downloads climate and observation data from Daymet and USGS, respectively.
 
@@ -28,27 +73,9 @@ def get_discharge(gis_dir, start, end, coords, station_id=None):
         climate (DataFrame): A Pandas dataframe including the following:
                              yday, dayl, prcp, srad, swe, tmax, tmin, vp, pet, qobs, tmean
     '''
-    from shapely.geometry import Point
-    from shapely.ops import nearest_points
-    import geopandas as gpd
-    from metpy.units import units
-
     if station_id is None:
-        # Get x, y coords from swmm if given and transform to lat, lon
         lon, lat = coords
-
-        loc_path = Path(gis_dir, 'GageLoc.shp')
-        if not loc_path.exists():
-            raise FileNotFoundError('GageLoc.shp cannot be found in ' +
-                                    str(gis_dir))
-        else:
-            gloc = gpd.read_file(loc_path)
-
-        # Get station ID based on lat/lon
-        point = Point(lon, lat)
-        pts = gloc.geometry.unary_union
-        station = gloc[gloc.geometry.geom_equals(nearest_points(point, pts)[1])]
-        station_id = station.SOURCE_FEA.values[0]
+        station_id = nearest_gauges(gis_dir, lon, lat)[0]
 
     start, end = pd.to_datetime(start), pd.to_datetime(end)
 
@@ -62,7 +89,131 @@ def get_discharge(gis_dir, start, end, coords, station_id=None):
     return df[['sitecode','val', 'unit']].copy()
 
 
-def nwis_json(site, parm='00060', start=None, end=None, period=None, freq='dv'):
+nwis_base = 'http://waterservices.usgs.gov/nwis/'
+
+
+def nwis_url(site, parm='00060', start=None, end=None, period=None, freq='dv', base=nwis_base):
+    if period is None and start is None and end is None:
+        period='P1D'
+    site = site if isinstance(site, str) else ','.join(str(s) for s in site)
+    parm = parm if isinstance(parm, str) else ','.join(str(p) for p in parm)
+
+    if period is None:
+        url = (base + freq +
+              '/?format=json&sites=' + str(site) +
+              '&startDT=' + start +
+              '&endDt=' + end +
+              '&parameterCd=' + str(parm))
+    else:
+        url = (base + freq +
+              '/?format=json&sites=' + str(site) +
+              '&period=' + period +
+              '&parameterCd=' + str(parm))
+    return url
+
+
+def _nwis_frame(datetimes, values, info):
+    """Builds the nwis_json frame from arrays of ISO-8601 strings and values."""
+    datetimes = pd.Series(np.asarray(datetimes, dtype=object), dtype=object)
+    time = pd.to_datetime(datetimes, utc=True)
+    # local wall-clock time from the UTC offset at the end of each string
+    offset = datetimes.str.extract(r'([+-])(\d{2}):(\d{2})$')
+    sign = np.where(offset[0] == '-', -1, 1)
+    minutes = sign * (offset[1].astype(float).fillna(0) * 60 + offset[2].astype(float).fillna(0))
+    timelocal = time.dt.tz_localize(None) + pd.to_timedelta(minutes, unit='m')
+
+    val = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=np.float64, copy=True)
+    val[val == info['noDataValue']] = np.nan
+
+    nwis = pd.DataFrame({'time': time, 'val': val, 'timelocal': timelocal})
+    for c in ['sitename', 'sitecode', 'unit', 'variableName', 'latitude', 'longitude', 'srs']:
+        nwis[c] = info[c]
+
+    return nwis[['time',
+                 'sitename',
+                 'sitecode',
+                 'val',
+                 'unit',
+                 'variableName',
+                 'timelocal',
+                 'latitude',
+                 'longitude',
+                 'srs']].set_index('time')
+
+
+def _nwis_info(pvt):
+    return {'sitename': pvt['sourceInfo']['siteName'],
+            'sitecode': pvt['sourceInfo']['siteCode'][0]['value'],
+            'latitude': pvt['sourceInfo']['geoLocation']['geogLocation']['latitude'],
+            'longitude': pvt['sourceInfo']['geoLocation']['geogLocation']['longitude'],
+            'srs': pvt['sourceInfo']['geoLocation']['geogLocation']['srs'],
+            'unit': pvt['variable']['unit']['unitCode'],
+            'variableName': pvt['variable']['variableName'],
+            'noDataValue': pvt['variable']['noDataValue']}
+
+
+def _nwis_stream(response, chunk=100000):
+    """Parses the first time series of an NWIS JSON response incrementally
+    with ijson; dates are converted every chunk samples so neither the raw
+    payload nor a list of all the samples is ever held in memory."""
+    import ijson
+    from array import array
+
+    ts = 'value.timeSeries.item'
+    info = {'sourceInfo': {'siteCode': [{}], 'geoLocation': {'geogLocation': {}}},
+            'variable': {'unit': {}}}
+    fields = {ts + '.sourceInfo.siteName': ('sourceInfo', 'siteName'),
+              ts + '.sourceInfo.siteCode.item.value': ('sourceInfo', 'siteCode', 0, 'value'),
+              ts + '.sourceInfo.geoLocation.geogLocation.latitude': (
+                  'sourceInfo', 'geoLocation', 'geogLocation', 'latitude'),
+              ts + '.sourceInfo.geoLocation.geogLocation.longitude': (
+                  'sourceInfo', 'geoLocation', 'geogLocation', 'longitude'),
+              ts + '.sourceInfo.geoLocation.geogLocation.srs': (
+                  'sourceInfo', 'geoLocation', 'geogLocation', 'srs'),
+              ts + '.variable.unit.unitCode': ('variable', 'unit', 'unitCode'),
+              ts + '.variable.variableName': ('variable', 'variableName'),
+              ts + '.variable.noDataValue': ('variable', 'noDataValue')}
+
+    def to_float(value):
+        # sentinels such as 'Ice' or 'Eqp' become NaN as with pd.to_numeric
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+
+    # only the first method of values is read, as in nwis_json
+    method = ts + '.values.item'
+    sample = method + '.value.item'
+    times, values = [], array('d')
+    frames = []
+    first = True
+    for prefix, event, value in ijson.parse(response):
+        if prefix == sample + '.dateTime':
+            if first:
+                times.append(value)
+        elif prefix == sample + '.value':
+            if first:
+                values.append(to_float(value))
+        elif prefix == method and event == 'end_map':
+            first = False
+        elif prefix in fields:
+            d = info
+            for k in fields[prefix][:-1]:
+                d = d[k]
+            d[fields[prefix][-1]] = value if isinstance(value, str) else float(value)
+        elif prefix == ts and event == 'end_map':
+            break
+        if len(times) >= chunk and len(values) == len(times):
+            frames.append((times, values))
+            times, values = [], array('d')
+    frames.append((times, values))
+
+    info = _nwis_info(info)
+    return pd.concat([_nwis_frame(t, v, info) for t, v in frames])
+
+
+def nwis_json(site, parm='00060', start=None, end=None, period=None, freq='dv',
+              stream=False):
     """Obtain NWIS data via JSON.
 
     Parameters
@@ -84,6 +235,9 @@ def nwis_json(site, parm='00060', start=None, end=None, period=None, freq='dv'):
         Duration following ISO-8601 duration format, e.g. 'P1D' for one day
         Default one day.
         If specifying period, do not specify start and end.
+    stream : bool, optional
+        Parse the response incrementally while it is downloaded (requires
+        ijson); useful for long 'iv' requests. Default False.
 
     Returns
     -------
@@ -95,7 +249,7 @@ def nwis_json(site, parm='00060', start=None, end=None, period=None, freq='dv'):
         - 'val': value
         - 'unit': unit
         - 'variableName': variable name
-        - 'timelocal': local time
+        - 'timelocal': local time (without time zone)
         - 'latitude': site latitude
         - 'longitude': site longitude
         - 'srs': latitude and longitude spatial reference system
@@ -105,82 +259,290 @@ def nwis_json(site, parm='00060', start=None, end=None, period=None, freq='dv'):
     dnowacki@usgs.gov 2016-07
     """
     import requests
-    from dateutil import parser
-    import pytz
 
-    if period is None and start is None and end is None:
-        period='P1D'
+    url = nwis_url(site, parm, start, end, period, freq)
 
-    if period is None:
-        url = ('http://waterservices.usgs.gov/nwis/' + freq +
-              '/?format=json&sites=' + str(site) +
-              '&startDT=' + start +
-              '&endDt=' + end +
-              '&parameterCd=' + str(parm))
-    else:
-        url = ('http://waterservices.usgs.gov/nwis/' + freq +
-              '/?format=json&sites=' + str(site) +
-              '&period=' + period +
-              '&parameterCd=' + str(parm))
+    if stream:
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            return _nwis_stream(r.raw)
 
     payload = requests.get(url).json()
-    v = payload['value']['timeSeries'][0]['values'][0]['value']
     pvt = payload['value']['timeSeries'][0]
-    nwis = {}
-    nwis['timelocal'] = np.array(
-        [parser.parse(v[i]['dateTime']) for i in range(len(v))])
-    # Convert local time to UTC
-    nwis['time'] = np.array([x.astimezone(pytz.utc) for x in nwis['timelocal']])
-    nwis['sitename'] = pvt['sourceInfo']['siteName']
-    nwis['sitecode'] = pvt['sourceInfo']['siteCode'][0]['value']
-    nwis['latitude'] = pvt['sourceInfo']['geoLocation']['geogLocation']['latitude']
-    nwis['longitude'] = pvt['sourceInfo']['geoLocation']['geogLocation']['longitude']
-    nwis['srs'] = pvt['sourceInfo']['geoLocation']['geogLocation']['srs']
-    nwis['unit'] = pvt['variable']['unit']['unitCode']
-    nwis['variableName'] = pvt['variable']['variableName']
-    nwis['val'] = np.array([float(v[i]['value']) for i in range(len(v))])
-    nwis['val'][nwis['val'] == pvt['variable']['noDataValue']] = np.nan
-
-    return pd.DataFrame(nwis,
-                        columns=['time',
-                                 'sitename',
-                                 'sitecode',
-                                 'val',
-                                 'unit',
-                                 'variableName',
-                                 'timelocal',
-                                 'latitude',
-                                 'longitude',
-                                 'srs']).set_index('time')
-
-
-def get_peaks(site):
+    v = pd.DataFrame(pvt['values'][0]['value'], columns=['dateTime', 'value'])
+    return _nwis_frame(v.dateTime.values, v.value.values, _nwis_info(pvt))
+
+
+def nwis_batch(sites, parms='00060', start=None, end=None, period=None, freq='dv',
+               max_sites=100, workers=8, base=nwis_base):
+    """Obtain NWIS data of many sites and parameters via JSON.
+
+    The sites are requested in groups of at most max_sites (NWIS accepts
+    comma-separated site and parameter lists) and the groups are fetched
+    concurrently over a shared session.
+
+    Parameters
+    ----------
+    sites : list of str
+        NWIS site codes.
+    parms : str or list of str, optional
+        Parameter codes. Default '00060'.
+    start, end, period, freq
+        Same as nwis_json.
+    max_sites : int, optional
+        Largest number of sites in a single request. Default 100.
+    workers : int, optional
+        Number of concurrent requests. Default 8.
+    base : str, optional
+        Root URL of the NWIS web services.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A long-format frame indexed by (sitecode, time) with the columns of
+        nwis_json and the parameter code in 'parm'. As in nwis_json, only
+        the first method of each time series is used. The frame is empty
+        (with the same columns) if no data were returned.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from noaa_stations import make_session
+
+    sites = list(dict.fromkeys(str(s) for s in sites))
+    groups = [sites[i:i + max_sites] for i in range(0, len(sites), max_sites)]
+
+    session = make_session(workers)
+
+    def fetch(group):
+        r = session.get(nwis_url(group, parms, start, end, period, freq, base))
+        r.raise_for_status()
+        frames = []
+        for pvt in r.json()['value']['timeSeries']:
+            if len(pvt['values']) == 0:
+                continue
+            v = pd.DataFrame(pvt['values'][0]['value'], columns=['dateTime', 'value'])
+            df = _nwis_frame(v.dateTime.values, v.value.values, _nwis_info(pvt))
+            df['parm'] = pvt['variable']['variableCode'][0]['value']
+            frames.append(df)
+        return frames
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = [f for group in executor.map(fetch, groups) for f in group]
+
+    if len(frames) == 0:
+        columns = ['sitename', 'val', 'unit', 'variableName', 'timelocal',
+                   'latitude', 'longitude', 'srs', 'parm']
+        return pd.DataFrame(columns=columns,
+                            index=pd.MultiIndex.from_arrays([[], []], names=['sitecode', 'time']))
+    return pd.concat(frames).reset_index().set_index(['sitecode', 'time']).sort_index()
+
+
+def get_discharges(station_ids, start, end, freq='dv', **kwargs):
+    """Daily discharge of many USGS gauges as a long-format frame indexed by
+    (sitecode, time); see nwis_batch for the other arguments."""
+    start, end = pd.to_datetime(start), pd.to_datetime(end)
+    df = nwis_batch(station_ids,
+                    parms='00060',
+                    start=start.strftime('%Y-%m-%d'),
+                    end=end.strftime('%Y-%m-%d'),
+                    freq=freq,
+                    **kwargs)
+    return df[['val', 'unit']].copy()
+
+
+peak_url = 'http://nwis.waterdata.usgs.gov/usa/nwis/peak'
+
+
+def _parse_peaks(text):
+    """Annual peaks of an hn2 response as a frame indexed by date (m^3/s)."""
     import io
     from metpy.units import units
 
-
-    url = ('http://nwis.waterdata.usgs.gov/usa/nwis/peak?site_no=' + str(site) + '&agency_cd=USGS&format=hn2')
-    payload = requests.get(url).content
-    rawData = pd.read_csv(io.StringIO(payload.decode('utf-8')), skiprows=4, header=None, delim_whitespace=True)
+    rawData = pd.read_csv(io.StringIO(text), skiprows=4, header=None, sep=r'\s+')
     rawData = rawData.loc[:, 1:3]
     rawData.columns = ['date', 'qpeak']
-    rawData['date'] = pd.to_datetime(rawData.date.astype('str'))
+    rawData['date'] = pd.to_datetime(rawData.date.astype('str'), format='%Y%m%d', errors='coerce')
     rawData.set_index('date', inplace=True, drop=True)
-    rawData['qpeak'] = rawData.qpeak.apply(lambda x: (x * units('ft^3/s')).to_base_units().magnitude)
-
+    cfs = (1.0 * units('ft^3/s')).to_base_units().magnitude
+    rawData['qpeak'] = pd.to_numeric(rawData.qpeak, errors='coerce').to_numpy() * cfs
     return rawData
 
 
-def get_lulc(input_dir, geometry, station_id, width=2000):
+def get_peaks(site, url=peak_url, session=None):
+    import requests
+
+    url = (url + '?site_no=' + str(site) + '&agency_cd=USGS&format=hn2')
+    r = (requests if session is None else session).get(url)
+    r.raise_for_status()
+    return _parse_peaks(r.content.decode('utf-8'))
+
+
+def get_peaks_batch(sites, workers=8, url=peak_url):
+    """
+    Annual peak flows (m^3/s) of many sites fetched concurrently over a
+    shared session.
+    Returns: a long-format frame indexed by (site, date) of the sites that
+             were fetched and a list of those that failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from noaa_stations import make_session
+
+    sites = list(dict.fromkeys(str(s) for s in sites))
+    session = make_session(workers)
+
+    def fetch(site):
+        try:
+            return get_peaks(site, url, session)
+        except Exception as e:
+            print(f'Site {site} failed: {e}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        peaks = list(executor.map(fetch, sites))
+    failed = [s for s, p in zip(sites, peaks) if p is None]
+    fetched = [s for s, p in zip(sites, peaks) if p is not None]
+    if len(fetched) == 0:
+        return pd.DataFrame(columns=['qpeak'],
+                            index=pd.MultiIndex.from_arrays([[], []], names=['site', 'date'])), failed
+    return pd.concat([p for p in peaks if p is not None], keys=fetched, names=['site', 'date']), failed
+
+
+def gev_lmoments(peaks):
+    """
+    Fits a GEV distribution to the annual peaks of every site at once with
+    the method of L-moments (Hosking, 1985).
+    Args:
+        peaks (DataFrame): the frame returned by get_peaks_batch
+    Returns:
+        params (DataFrame): location (xi), scale (alpha) and shape (k) of each
+                            site in Hosking's convention, where k > 0 is a
+                            bounded upper tail.
+    """
+    from scipy.special import gamma
+
+    q = peaks.qpeak.dropna()
+    counts = q.groupby(level=0).cumcount()
+    x = q.reset_index(level=1, drop=True).to_frame()
+    x['i'] = counts.values
+    x = x.pivot(columns='i', values='qpeak')
+    sites = x.index
+
+    x = np.sort(x.values, axis=1)
+    n = np.isfinite(x).sum(axis=1)[:, None].astype(np.float64)
+    i = np.arange(x.shape[1])[None, :]
+    x = np.nan_to_num(x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b0 = x.sum(axis=1) / n[:, 0]
+        b1 = (x * i / (n - 1)).sum(axis=1) / n[:, 0]
+        b2 = (x * i * (i - 1) / ((n - 1) * (n - 2))).sum(axis=1) / n[:, 0]
+
+        l1, l2, l3 = b0, 2 * b1 - b0, 6 * b2 - 6 * b1 + b0
+        c = 2.0 / (3.0 + l3 / l2) - np.log(2.0) / np.log(3.0)
+        k = 7.8590 * c + 2.9554 * c**2
+        alpha = l2 * k / ((1 - 2.0**-k) * gamma(1 + k))
+        xi = l1 - alpha * (1 - gamma(1 + k)) / k
+
+    params = pd.DataFrame({'xi': xi, 'alpha': alpha, 'k': k, 'n': n[:, 0].astype(int)},
+                          index=sites)
+    params.loc[params.n < 3, ['xi', 'alpha', 'k']] = np.nan
+    return params
+
+
+def gev_quantiles(params, return_periods=(2, 10, 50, 100)):
+    """Flood quantiles of the fitted GEV for the given return periods (years)."""
+    y = -np.log(1.0 - 1.0 / np.asarray(return_periods, dtype=np.float64))
+    k = params.k.values[:, None]
+    q = params.xi.values[:, None] + params.alpha.values[:, None] / k * (1 - y**k)
+    return pd.DataFrame(q, index=params.index, columns=list(return_periods))
+
+
+nlcd_urls = {'impervious' : 'https://www.mrlc.gov/geoserver/mrlc_display/' \
+                            + 'mrlc_nlcd_2011_impervious_2011_edition_2014_10_10/' \
+                            + 'wms?service=WMS&request=GetCapabilities',
+             'cover' : 'https://www.mrlc.gov/geoserver/mrlc_display/' \
+                       + 'mrlc_nlcd_2011_landcover_2011_edition_2014_10_10/' \
+                       + 'wms?service=WMS&request=GetCapabilities',
+             'canopy' : 'https://www.mrlc.gov/geoserver/mrlc_display/' \
+                        + 'mrlc_nlcd2011_usfs_conus_canopy_cartographic/'\
+                        + 'wms?service=WMS&request=GetCapabilities'}
+
+
+def nlcd_tiles(geometry, tile_size=0.1):
+    """Indices (ix, iy) of the tiles of a tile_size-degree grid that intersect
+    the polygon."""
+    from shapely.geometry import box
+
+    xmin, ymin, xmax, ymax = geometry.bounds
+    tiles = []
+    for ix in range(int(np.floor(xmin / tile_size)), int(np.floor(xmax / tile_size)) + 1):
+        for iy in range(int(np.floor(ymin / tile_size)), int(np.floor(ymax / tile_size)) + 1):
+            if geometry.intersects(box(ix * tile_size, iy * tile_size,
+                                       (ix + 1) * tile_size, (iy + 1) * tile_size)):
+                tiles.append((ix, iy))
+    return tiles
+
+
+def _nlcd_tile(wms, fname, ix, iy, tile_size, width):
+    img = wms.getmap(layers=list(wms.contents),
+                     srs='epsg:4326',
+                     bbox=(ix * tile_size, iy * tile_size,
+                           (ix + 1) * tile_size, (iy + 1) * tile_size),
+                     size=(width, width),
+                     format='image/geotiff',
+                     transparent=True)
+    from store import _tmp_name
+
+    tmp = _tmp_name(fname)
+    with open(tmp, 'wb') as out:
+        out.write(img.read())
+    os.replace(tmp, fname)
+    return fname
+
+
+def _zonal(tiles, geometry):
+    """Values of the tiles inside the polygon; only the window of each tile
+    that overlaps the polygon is read and tiles that merely touch it are
+    skipped."""
+    import rasterio
+    from rasterio.features import geometry_mask
+    from rasterio.windows import from_bounds
+    from shapely.geometry import box
+
+    values = []
+    for fname in tiles:
+        with rasterio.open(fname) as src:
+            overlap = geometry.intersection(box(*src.bounds))
+            if overlap.area == 0:
+                continue
+            window = from_bounds(*overlap.bounds, transform=src.transform)
+            window = window.round_offsets().round_lengths().intersection(
+                rasterio.windows.Window(0, 0, src.width, src.height))
+            if window.width < 1 or window.height < 1:
+                continue
+            data = src.read(1, window=window, masked=True)
+            inside = ~geometry_mask([geometry],
+                                    out_shape=data.shape,
+                                    transform=src.window_transform(window),
+                                    all_touched=False)
+            values.append(data[inside & ~np.ma.getmaskarray(data)].data)
+    return np.concatenate(values) if values else np.array([])
+
+
+def get_lulc(input_dir, geometry, station_id=None, width=512, tile_size=0.1, workers=6):
     '''Download and compute land use, canopy and cover from NLCD database
        inside a given Polygon with epsg:4326 projection (lat/lon).
        Note: NLCD data corresponds to 30 m cells.
+       The layers are cached as tiles of a tile_size-degree grid under
+       input_dir/nlcd_tiles/{layer} so neighbouring watersheds share them;
+       missing tiles of the three layers are downloaded concurrently.
        Args:
            input_dir (str): path to inpu directory for saving the data
            geometry (Polygon): a Polygon object encompassing the whole watershed.
-           station_id (str):station id of the watershed for naming the output files.
-           width (int): width of the output files in pixels (height will be
-                        computed automatically from aspect ratio of the domain)
+           station_id (str): not used anymore since the tiles are shared
+                             between watersheds.
+           width (int): width and height of each tile in pixels.
+           tile_size (float): size of the tiles in degrees.
+           workers (int): number of concurrent downloads.
        Returns:
            impervious (dict): a dictionary containing min, max, mean and count
                               of the imperviousness of the watershed
@@ -189,113 +551,69 @@ def get_lulc(input_dir, geometry, station_id, width=2000):
            cover (dataframe): a dataframe containing watershed's land coverage
                               percentage.
     '''
+    from concurrent.futures import ThreadPoolExecutor
     from owslib.wms import WebMapService
-    from rasterstats import zonal_stats
     from src.nlcd_helper import NLCD
 
-    if not Path(input_dir).is_dir():
-        try:
-            import os
-            os.mkdir(input_dir)
-        except OSError:
-            print("input directory cannot be created: {:s}".format(path))
-
-    urls = {'impervious' : 'https://www.mrlc.gov/geoserver/mrlc_display/' \
-                           + 'mrlc_nlcd_2011_impervious_2011_edition_2014_10_10/' \
-                           + 'wms?service=WMS&request=GetCapabilities',
-            'cover' : 'https://www.mrlc.gov/geoserver/mrlc_display/' \
-                      + 'mrlc_nlcd_2011_landcover_2011_edition_2014_10_10/' \
-                      + 'wms?service=WMS&request=GetCapabilities',
-            'canopy' : 'https://www.mrlc.gov/geoserver/mrlc_display/' \
-                       + 'mrlc_nlcd2011_usfs_conus_canopy_cartographic/'\
-                       + 'wms?service=WMS&request=GetCapabilities'}
-
-    params = {}
-    for data_type, url in urls.items():
-        data = "/".join([input_dir, "_".join([station_id, data_type])]) + '.geotiff'
-        if not Path(data).exists():
-            bbox = geometry.bounds
-            height = int(
-                np.abs(bbox[1] - bbox[3]) / np.abs(bbox[0] - bbox[2]) * width)
-            wms = WebMapService(url)
+    tiles = nlcd_tiles(geometry, tile_size)
+    paths = {}
+    for data_type in nlcd_urls:
+        tile_dir = Path(input_dir, 'nlcd_tiles', data_type)
+        tile_dir.mkdir(parents=True, exist_ok=True)
+        paths[data_type] = [Path(tile_dir, f'{tile_size:g}_{ix}_{iy}.geotiff') for ix, iy in tiles]
+
+    missing = [(data_type, f, t) for data_type in nlcd_urls
+               for f, t in zip(paths[data_type], tiles) if not f.exists()]
+    if len(missing) > 0:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            wms = dict(zip(nlcd_urls, executor.map(WebMapService, nlcd_urls.values())))
+            jobs = [executor.submit(_nlcd_tile, wms[d], f, ix, iy, tile_size, width)
+                    for d, f, (ix, iy) in missing]
             try:
-                img = wms.getmap(layers=list(wms.contents),
-                                 srs='epsg:4326',
-                                 bbox=geometry.bounds,
-                                 size=(width, height),
-                                 format='image/geotiff',
-                                 transparent=True)
+                [j.result() for j in jobs]
             except ConnectionError:
-                raise ('Data is not availble on the server.')
+                raise ConnectionError('Data is not availble on the server.')
 
-            with open(data, 'wb') as out:
-                out.write(img.read())
-        else:
-            pass  # print('Using existing local data for ' + data_type)
-
-        categorical = True if data_type == 'cover' else False
-        params[data_type] = zonal_stats(geometry,
-                                        data,
-                                        categorical=categorical)[0]
-
-    cover = pd.Series(params['cover'])
-    cover = cover / cover.sum() * 100
-    cover.index = cover.index.astype('str')
-    cover = cover.to_frame('percent')
-    cover['type'] = [
-        cat for name, cat in NLCD().values.items() for i in cover.index
-        if i in name
-    ]
+    params = {}
+    for data_type in ['impervious', 'canopy']:
+        v = _zonal(paths[data_type], geometry)
+        params[data_type] = {'min': v.min() if v.size else None,
+                             'max': v.max() if v.size else None,
+                             'mean': v.mean() if v.size else None,
+                             'count': int(v.size)}
+
+    counts = np.bincount(_zonal(paths['cover'], geometry).astype(np.int64), minlength=256)
+    classes = np.nonzero(counts)[0]
+
+    lookup = np.full(counts.size, None, dtype=object)
+    for name, cat in NLCD().values.items():
+        code = ''.join(c for c in str(name) if c.isdigit())
+        if code and int(code) < lookup.size:
+            lookup[int(code)] = cat
+
+    cover = pd.DataFrame({'percent': counts[classes] / counts.sum() * 100},
+                         index=classes.astype('str'))
+    cover['type'] = lookup[classes]
     #cover = cover.groupby('type').sum()
     return params['impervious'], params['canopy'], cover
 
 
-def daac_download(saveDir, files):
-    """
-    ---------------------------------------------------------------------------------------------------
-     How to Access the LP DAAC Data Pool with Python
-     The following Python code example demonstrates how to configure a connection to download data from
-     an Earthdata Login enabled server, specifically the LP DAAC's Data Pool.
-    ---------------------------------------------------------------------------------------------------
-     Author: Cole Krehbiel
-     Last Updated: 11/20/2018
-    ---------------------------------------------------------------------------------------------------
-    Args:
-        saveDir (str): Specify directory to save files to
-        files (str): A single granule URL, or the location of textfile containing granule URLs
-    return:
-        path (str): path to the downloaded file
-    """
-    # Load necessary packages into Python
+def earthdata_credentials(urs='urs.earthdata.nasa.gov'):
+    """Reads NASA Earthdata Login credentials from ~/.netrc and prompts for
+    them (adding them to ~/.netrc) if they are not there."""
     from subprocess import Popen
     from getpass import getpass
     from netrc import netrc
     import time
-    import requests
 
-    # ----------------------------------USER-DEFINED VARIABLES--------------------------------------- #
     prompts = [
         'Enter NASA Earthdata Login Username \n(or create an account at urs.earthdata.nasa.gov): ',
         'Enter NASA Earthdata Login Password: '
     ]
 
-    # ---------------------------------SET UP WORKSPACE---------------------------------------------- #
-    # Create a list of files to download based on input type of files above
-    if files.endswith('.txt'):
-        fileList = open(files,
-                        'r').readlines()  # If input is textfile w file URLs
-    elif isinstance(files, str):
-        fileList = [files]  # If input is a single file
-
-    # Generalize download directory
-    if saveDir[-1] != '/' and saveDir[-1] != '\\':
-        saveDir = saveDir.strip("'").strip('"') + os.sep
-    urs = 'urs.earthdata.nasa.gov'  # Address to call for authentication
-
-    # --------------------------------AUTHENTICATION CONFIGURATION----------------------------------- #
     # Determine if netrc file exists, and if so, if it includes NASA Earthdata Login Credentials
+    netrcDir = os.path.expanduser("~/.netrc")
     try:
-        netrcDir = os.path.expanduser("~/.netrc")
         netrc(netrcDir).authenticators(urs)[0]
 
     # Below, create a netrc file and prompt user for NASA Earthdata Login Username and Password
@@ -325,42 +643,185 @@ def daac_download(saveDir, files):
               shell=True)
 
     # Delay for up to 1 minute to allow user to submit username and password before continuing
-    tries = 0
-    while tries < 30:
+    for _ in range(30):
         try:
-            netrc(netrcDir).authenticators(urs)[2]
-        except:
+            login, _, password = netrc(netrcDir).authenticators(urs)
+            return login, password
+        except (FileNotFoundError, TypeError):
             time.sleep(2.0)
-        tries += 1
-
-    # -----------------------------------------DOWNLOAD FILE(S)-------------------------------------- #
-    # Loop through and download all files to the directory specified above, and keeping same filenames
-    for f in fileList:
-        if not os.path.exists(saveDir):
-            os.makedirs(saveDir)
-        saveName = os.path.join(saveDir, f.split('/')[-1].strip())
-
-        # Create and submit request and download file
-        with requests.get(
-                f.strip(),
-                stream=True,
-                auth=(netrc(netrcDir).authenticators(urs)[0],
-                      netrc(netrcDir).authenticators(urs)[2])) as response:
-            if response.status_code != 200:
-                print(
-                    "{} not downloaded. Verify that your username and password are correct in {}"
-                    .format(f.split('/')[-1].strip(), netrcDir))
+    raise ValueError(f'Earthdata Login credentials for {urs} were not found in {netrcDir}')
+
+
+def earthdata_session(auth, urs='urs.earthdata.nasa.gov', workers=4):
+    """A pooled session that keeps the credentials only on redirects to or
+    from the Earthdata Login server."""
+    import requests
+    from urllib.parse import urlparse
+    from noaa_stations import make_session
+
+    class EarthdataSession(requests.Session):
+        def rebuild_auth(self, prepared_request, response):
+            original = urlparse(response.request.url).hostname
+            redirect = urlparse(prepared_request.url).hostname
+            if ('Authorization' in prepared_request.headers and
+                    original != redirect and urs not in (original, redirect)):
+                del prepared_request.headers['Authorization']
+
+    session = make_session(workers, session=EarthdataSession())
+    session.auth = auth
+    return session
+
+
+def _download(session, url, fname, checksum=None, algorithm='md5', chunk_size=1024**2):
+    """Downloads url into fname through fname.part, resuming a partial file
+    with an HTTP Range request, and verifies its size and checksum."""
+    import hashlib
+
+    part = Path(str(fname) + '.part')
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+
+    with session.get(url, stream=True, headers=headers, timeout=60) as r:
+        if r.status_code == 416:
+            # the partial file is already as long as the server's copy or longer
+            size = r.headers.get('Content-Range', '').rpartition('/')[2]
+            if size.isdigit():
+                size = int(size)
             else:
-                response.raw.decode_content = True
-                content = response.raw
-                with open(saveName, 'wb') as d:
-                    while True:
-                        chunk = content.read(16 * 1024)
-                        if not chunk:
-                            break
-                        d.write(chunk)
-                print('Downloaded file: {}'.format(saveName))
-    return saveName
+                h = session.head(url, allow_redirects=True, timeout=60)
+                size = int(h.headers['Content-Length']) if 'Content-Length' in h.headers else None
+            if size != offset:
+                part.unlink()
+                raise IOError(f'{fname.name}: partial file of {offset} bytes does not match '
+                              + f'the remote size ({size}), restarting')
+        else:
+            r.raise_for_status()
+            if r.status_code != 206:
+                offset = 0
+            size = r.headers.get('Content-Range', '').rpartition('/')[2]
+            if size.isdigit():
+                size = int(size)
+            elif 'Content-Length' in r.headers:
+                size = offset + int(r.headers['Content-Length'])
+            else:
+                size = None
+            with open(part, 'ab' if offset > 0 else 'wb') as d:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    d.write(chunk)
+
+    if size is not None and part.stat().st_size != size:
+        if part.stat().st_size > size:
+            part.unlink()
+        raise IOError(f'{fname.name}: expected {size} bytes, got {part.stat().st_size}')
+
+    digest = None
+    if checksum is not None:
+        h = hashlib.new(algorithm)
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        if digest != checksum.lower():
+            part.unlink()
+            raise IOError(f'{fname.name}: {algorithm} checksum mismatch')
+
+    os.replace(part, fname)
+    return {'url': url, 'size': fname.stat().st_size, 'checksum': digest}
+
+
+def daac_download(saveDir, files, workers=4, checksums=None, algorithm='md5',
+                  auth=None, urs='urs.earthdata.nasa.gov', retries=3):
+    """
+    Downloads granules from an Earthdata Login enabled server such as the
+    LP DAAC's Data Pool, adapted from "How to Access the LP DAAC Data Pool
+    with Python" by Cole Krehbiel (11/20/2018).
+
+    The files are downloaded by a pool of workers sharing an authenticated
+    session. Interrupted transfers are resumed from their .part files and
+    every file is checked against its expected size (and checksum if given).
+    Completed files are recorded in saveDir/manifest.json so reruns skip them.
+
+    Args:
+        saveDir (str): Specify directory to save files to
+        files (str or list): A single granule URL, the location of textfile
+                             containing granule URLs, or a list of URLs
+        workers (int): number of concurrent downloads
+        checksums (dict): optional mapping of file name to its hex digest
+        algorithm (str): hashlib algorithm of the checksums
+        auth (str, str): username and password; read from ~/.netrc by default
+        urs (str): address of the Earthdata Login server
+        retries (int): number of attempts for each file
+    return:
+        path (str or list): path to the downloaded file, or a list of paths
+                            if several files were requested
+    """
+    import json
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from store import _tmp_name, _locked
+
+    if retries < 1:
+        raise ValueError('retries should be at least 1.')
+
+    # Create a list of files to download based on input type of files above
+    single = isinstance(files, str) and not files.endswith('.txt')
+    if isinstance(files, str) and files.endswith('.txt'):
+        with open(files, 'r') as f:
+            fileList = [l.strip() for l in f if l.strip()]
+    elif isinstance(files, str):
+        fileList = [files.strip()]
+    else:
+        fileList = [f.strip() for f in files]
+
+    saveDir = Path(saveDir.strip("'").strip('"'))
+    saveDir.mkdir(parents=True, exist_ok=True)
+    checksums = {} if checksums is None else checksums
+
+    manifest_path = Path(saveDir, 'manifest.json')
+    manifest = {}
+    if manifest_path.exists():
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    lock = threading.Lock()
+
+    session = earthdata_session(earthdata_credentials(urs) if auth is None else auth,
+                                urs, workers)
+
+    def fetch(url):
+        name = url.split('/')[-1]
+        saveName = Path(saveDir, name)
+        done = manifest.get(name)
+        if (done is not None and saveName.exists() and
+                saveName.stat().st_size == done['size'] and
+                (name not in checksums or done['checksum'] == checksums[name].lower())):
+            return str(saveName)
+
+        for attempt in range(retries):
+            try:
+                record = _download(session, url, saveName, checksums.get(name), algorithm)
+                break
+            except (IOError, OSError) as e:
+                if attempt == retries - 1:
+                    print(f'{name} not downloaded: {e}')
+                    return None
+
+        # other processes may be downloading into saveDir too, so the manifest
+        # is reread and merged under a file lock
+        with lock, _locked(saveDir):
+            if manifest_path.exists():
+                with open(manifest_path, 'r') as f:
+                    manifest.update(json.load(f))
+            manifest[name] = record
+            tmp = _tmp_name(manifest_path)
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(tmp, manifest_path)
+        print('Downloaded file: {}'.format(saveName))
+        return str(saveName)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        paths = list(executor.map(fetch, fileList))
+    return paths[0] if single else paths
 
 
 def get_inputs(f_in):
@@ -427,69 +888,110 @@ def conversion(coords):
     return (float(new[0]) + float(new[1])/60.0 + float(new[2])/3600.0) * direction[new_dir]
 
 
-def write_wl_bc(water_level, key, ptype):
-    if not Path(ptype).exists():
-        Path(ptype).mkdir()
+template_dir = Path(__file__).resolve().parent / 'templates'
 
-    if ptype == 'dflow':
-        bcs = ['templates/WaterLevel_1.bc', 'templates/WaterLevel_2.bc']
-        bc_1 = 'WaterLevel_1.bc'
-        bc_2 = 'WaterLevel_2.bc'
 
-        shutil.copyfile(bcs[0], bc_1)
-        shutil.copyfile(bcs[1], bc_2)
+def _template(name, start_date):
+    with open(Path(template_dir, name), 'r') as f:
+        text = f.read()
+    return text.replace('seconds since 2001-01-01 00:00:00', 'seconds since ' + str(start_date))
 
-        with fileinput.FileInput([bc_1, bc_2], inplace=True) as file:
-            for line in file:
-                print(line.replace('seconds since 2001-01-01 00:00:00', 'seconds since ' + str(water_level.index[0])), end='')
-        [water_level.to_csv(f, sep=' ', mode='a', header=None, index=False) for f in [bc_1, bc_2]]
 
-        with open(Path(ptype, 'WaterLevel_' + key.strip() + '.bc'), 'w') as f:
-            for bc in [bc_1, bc_2]:
-                with open(bc,'r') as file: f.write(file.read())
+def write_wl_bc(water_level, key, ptype, out_dir='.', start=None):
+    """
+    Writes the water level boundary condition in one pass. water_level is a
+    frame of seconds since its first date and levels indexed by date, or a
+    pair of arrays of seconds and levels together with their start date;
+    the seconds are written as integers. The output goes to out_dir/ptype
+    and nothing else is created or removed.
+    """
+    out = Path(out_dir, ptype)
+    out.mkdir(parents=True, exist_ok=True)
+    if not isinstance(water_level, pd.DataFrame):
+        if start is None:
+            raise ValueError('start is required when water_level is a pair of arrays.')
+        sec, level = water_level
+        water_level = pd.DataFrame({'sec': sec, 'level': level})
+        water_level.index = pd.Timestamp(start) + pd.to_timedelta(water_level.sec, unit='s')
+    elif not isinstance(water_level.index, pd.DatetimeIndex):
+        raise ValueError('water_level should be indexed by date.')
+    sec = water_level.columns[0]
+    water_level = water_level.assign(**{sec: water_level[sec].round().astype('int')})
 
-        [os.remove(f) for f in Path().glob('*.bak')]
-        [os.remove(f) for f in Path().glob('*.bc')]
+    if ptype == 'dflow':
+        with open(Path(out, 'WaterLevel_' + key.strip() + '.bc'), 'w') as f:
+            for bc in ['WaterLevel_1.bc', 'WaterLevel_2.bc']:
+                f.write(_template(bc, water_level.index[0]))
+                water_level.to_csv(f, sep=' ', header=None, index=False)
     elif ptype == 'geoclaw':
-        water_level.to_csv(Path(ptype, 'water_level_' + key.strip() + '.bc'),
-                           sep=' ', mode='a', header=None, index=False)
+        with open(Path(out, 'water_level_' + key.strip() + '.bc'), 'w') as f:
+            water_level.to_csv(f, sep=' ', header=None, index=False)
     else:
         raise KeyError('key can only be dflow or geoclaw')
 
 
-def write_q_bc(start_date, start_sec, end_sec, discharge, ptype):
-    if not Path(ptype).exists():
-        Path(ptype).mkdir()
+def write_q_bc(start_date, start_sec, end_sec, discharge, ptype, out_dir='.'):
+    """
+    Writes the low, reference and high discharge boundary conditions in one
+    pass each into out_dir/ptype without touching any other file.
+    """
+    out = Path(out_dir, ptype)
+    out.mkdir(parents=True, exist_ok=True)
 
     if ptype == 'dflow':
-        tmp = 'templates/Discharge.bc'
-        bcs = [Path(ptype, 'Discharge_low.bc'),
-               Path(ptype, 'Discharge_ref.bc'),
-               Path(ptype, 'Discharge_high.bc')]
-
-        [shutil.copyfile(tmp, bc) for bc in bcs]
-
-        with fileinput.FileInput(bcs, inplace=True) as file:
-            for line in file:
-                print(line.replace('seconds since 2001-01-01 00:00:00', 'seconds since ' + str(start_date)), end='')
-
-        for bc, q in zip(bcs, discharge):
-            with fileinput.FileInput(bc, inplace=True) as file:
-                for line in file:
-                    print(line.replace('tmin     Q', str(start_sec) + '    ' + str(q)), end='')
-
-            with fileinput.FileInput(bc, inplace=True) as file:
-                for line in file:
-                    print(line.replace('tmax     Q', str(end_sec) + '    ' + str(q)), end='')
-
-        [os.remove(f) for f in Path().glob('*.bak')]
-        [os.remove(f) for f in Path().glob('*.bc')]
+        tmp = _template('Discharge.bc', start_date)
+        for name, q in zip(['low', 'ref', 'high'], discharge):
+            with open(Path(out, 'Discharge_' + name + '.bc'), 'w') as f:
+                f.write(tmp.replace('tmin     Q', str(start_sec) + '    ' + str(q))
+                           .replace('tmax     Q', str(end_sec) + '    ' + str(q)))
     elif ptype == 'geoclaw':
-        file = Path(ptype, 'discharge.bc')
+        file = Path(out, 'discharge.bc')
         with open(file, 'w') as f:
             f.write(f'Q_low = {discharge[0]:.5f}\n')
             f.write(f'Q_ref = {discharge[1]:.5f}\n')
             f.write(f'Q_high = {discharge[2]:.5f}\n')
             
     else:
-        raise KeyError('key can only be dflow or geoclaw')
\ No newline at end of file
+        raise KeyError('key can only be dflow or geoclaw')
+
+
+def read_pli(fname):
+    """
+    Reads the polylines of a D-Flow FM .pli file.
+    Returns: a frame with the boundary, name, x and y of every support point;
+             points without a label are named <boundary>_<0001, 0002, ...>
+             as D-Flow FM does.
+    """
+    with open(fname, 'r') as f:
+        lines = [l.split() for l in f if l.strip() and not l.lstrip().startswith('*')]
+
+    points, i = [], 0
+    while i < len(lines):
+        boundary, rows = lines[i][0], int(lines[i + 1][0])
+        for n, l in enumerate(lines[i + 2:i + 2 + rows]):
+            name = l[2] if len(l) > 2 else f'{boundary}_{n + 1:04d}'
+            points.append((boundary, name, float(l[0]), float(l[1])))
+        i += 2 + rows
+    return pd.DataFrame(points, columns=['boundary', 'name', 'x', 'y'])
+
+
+def write_points_bc(forcing, fname, quantity='waterlevelbnd', unit='m'):
+    """
+    Writes a D-Flow FM .bc file with a time series block for each support
+    point (column of forcing, named after the point) in one pass. Times are
+    in seconds since the first date of the forcing index.
+    """
+    sec = ((forcing.index - forcing.index[0]) / pd.Timedelta(seconds=1)).astype('int')
+    header = (['[forcing]'] +
+              [f'{k:<32}= {{}}' for k in ['Name', 'Function', 'Time-interpolation',
+                                        'Quantity', 'Unit', 'Quantity', 'Unit']])
+    header = '\n'.join(header) + '\n\n'
+
+    Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    with open(fname, 'w') as f:
+        for i, name in enumerate(forcing.columns):
+            f.write(('\n' if i > 0 else '') +
+                    header.format(name, 'timeseries', 'linear', 'time',
+                                  f'seconds since {forcing.index[0]}', quantity, unit))
+            pd.DataFrame({'sec': sec, 'wl': forcing[name].values}).to_csv(
+                f, sep=' ', header=None, index=False)
@@ -39,19 +39,5 @@ water_level['prediction'] = np.hstack(p)
 
 data = tc.get_tides('20180101', '20181231', -88.2, 30.4)
 
-wl = data.predicted_wl.copy()
-grouped = wl.groupby(pd.Grouper(freq='M'))
-
-def f(group):
-        return pd.DataFrame({'original': group, 'demeaned': group - group.mean()})
-
-wl_demeaned = grouped.apply(f)
-
-min_month = wl_demeaned.rolling(30).min().groupby(pd.Grouper(freq='M')).last()
-max_month = wl_demeaned.rolling(30).max().groupby(pd.Grouper(freq='M')).last()
-monthly_minmax = min_month.copy()
-monthly_minmax['high'] = max_month['demeaned']
-monthly_minmax = monthly_minmax[['demeaned', 'high']]
-monthly_minmax.columns = ['low', 'high']
-monthly_minmax['range'] = monthly_minmax.high - monthly_minmax.low
-monthly_minmax.sort_values('range')
\ No newline at end of file
+monthly_minmax = tc.monthly_ranges(data.predicted_wl)
+monthly_minmax.sort_values('range')